@@ -0,0 +1,202 @@
+"""Checks of behaviour, mostly against the stub server, as doctests.
+
+    python -m pytest --doctest-modules benchmarks/checks.py
+
+Syncing a story fetches the replies added since, even when others were deleted
+meanwhile, whether the story is a JSON, JSON Lines or story store file:
+
+>>> sync_after_edits(".json", deleted=5, added=5)
+(5, [500, 501, 502, 503, 504])
+>>> sync_after_edits(".jsonl", deleted=5, added=5)
+(5, [500, 501, 502, 503, 504])
+>>> sync_after_edits(".sqlite", deleted=5, added=5)
+(5, [500, 501, 502, 503, 504])
+>>> sync_after_edits(".json", deleted=0, added=30)[0]
+30
+>>> sync_after_edits(".json", deleted=5, added=0)
+(0, [])
+
+Requests the server fails are retried until they succeed.  Of 12 pages fetched
+one after the other from a server that fails every third request, 5 requests
+fail, and all pages arrive:
+
+>>> fetch_pages(12, fail_every=3)[:2]
+(True, 5)
+
+A server that takes fewer requests at once than are sent throttles some, and
+then gets fewer at once, for a while:
+
+>>> ok, throttled, limit = fetch_pages(40, workers=8, max_concurrent=2)
+>>> ok, throttled > 0, limit < 8
+(True, True, True)
+
+One quick response does not make the usual, slower ones look like congestion:
+the client keeps sending as many requests at once as it may.
+
+>>> mixed_latencies(0.005, 0.05, pages=64, workers=8) == 8
+True
+
+After a ``Retry-After``, the next request waits as long as it asks, longer than
+the backoff would:
+
+>>> retry_wait(1.0) >= 1.0
+True
+
+`typography.smarten` makes exactly what smartypants does of quotes and dashes,
+in synthetic posts, in nested quotes, ``--`` and ``---``, ``...``, entities and
+backslash escapes, and in random mixes of those:
+
+>>> smarten_mismatches(posts=1000, mixes=20000)
+[]
+"""
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import random
+import tempfile
+from typing import Any, Final
+
+from glowfic_scrape import download_thread, story_file
+from glowfic_scrape.common_types import PostInfo, Story
+from glowfic_scrape.http_client import Client
+from glowfic_scrape.smartypants import Attr, smartypants
+from glowfic_scrape.typography import smarten
+
+from .stub import PAGE_SIZE, StubServer
+from .synthetic import make_adversarial, make_story
+
+__all__ = [
+    "sync_after_edits",
+    "fetch_pages",
+    "mixed_latencies",
+    "retry_wait",
+    "smarten_mismatches",
+]
+
+_EDGE_CASES: Final = [
+    "\"She said 'he said \"no\"' and left.\"",
+    "'\"Nested,\" she said,' he said.",
+    "\"'Twas,\" '\"quoted\"' ''double'' \"\"\"",
+    "a--b a---b a -- b a --- b -- ---- - -a- a-",
+    "wait... ...\"what\"... . . . '...'",
+    "&quot;x&quot; &#8220;y&#8221; &mdash;\"z\" &#8212;'w' &#x2014;\"v\" &nbsp;'u'",
+    "\\\"a\\\" \\'b\\' \\-- \\... \\\\ \\` \\x",
+    "<b>\"</b>bold\"<i>'</i> <code>\"c\"</code> <!-- \"k\" --> <pre>'p'</pre>",
+]
+"""Texts that smartypants treats specially."""
+_PIECES: Final = [
+    " ",
+    "\n",
+    ". . .",
+    "<a href=\"'x'\">",
+    *r"""" ' - -- --- ... `` '' 's 'tis \ \" \' \- \. &quot; &#8212; &mdash; &nbsp;
+    <b> </b> <code> </code> <!-- --> a 5 ( [ > <""".split(),
+]
+"""What the random texts of `smarten_mismatches` are made of."""
+
+
+def sync_after_edits(
+    suffix: str, deleted: int, added: int, size: int = 100
+) -> tuple[int, list[int]]:
+    """Sync a story of `size` posts after the server deleted and added replies.
+
+    Replies are deleted from the middle of the thread, and the new ones get ids
+    from 500.  Returns what `sync` returned and the ids of the replies it added.
+    """
+    story = make_story(size)
+    with tempfile.TemporaryDirectory() as tmp, StubServer(story) as stub:
+        path = Path(tmp) / f"story{suffix}"
+        if suffix == ".sqlite":
+            path = Path(f"{path}#{story['posts'][0]['id']:d}")
+        story_file.write_story(story, path)
+        posts = story["posts"]
+        new: list[PostInfo] = [
+            {**post, "id": 500 + i} for i, post in enumerate(posts[1 : added + 1])
+        ]
+        stub.story = Story(
+            story, posts=posts[: size // 2] + posts[size // 2 + deleted :] + new
+        )
+        api_root = download_thread.API_ROOT
+        download_thread.API_ROOT = f"{stub.url}/api/v1"
+        try:
+            synced = download_thread.sync(path)
+        finally:
+            download_thread.API_ROOT = api_root
+        before = {post["id"] for post in posts}
+        after = [post["id"] for post in story_file.load_story(path)["posts"]]
+        return synced, [i for i in after if i not in before]
+
+
+def fetch_pages(
+    pages: int, workers: int = 1, **throttling: Any
+) -> tuple[bool, int, float]:
+    """Fetch pages of replies from a stub server that throttles as `throttling`.
+
+    Returns whether every page arrived, how many requests the server throttled
+    and the fewest requests at once the client allowed after a response.
+    """
+    story = make_story(pages * PAGE_SIZE + 1)
+    client = Client(max_per_host=workers)
+    with StubServer(story, **throttling) as stub:
+        urls = [
+            f"{stub.url}/api/v1/posts/1/replies?page={i:d}"
+            for i in range(1, pages + 1)
+        ]
+        limits: list[float] = []
+
+        def fetch(url: str) -> Any:
+            page = client.get_json(url)
+            limits.extend(host.limit for host in client._hosts.values())
+            return page
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            replies = list(pool.map(fetch, urls))
+        client.close()
+    complete = all(len(page) == PAGE_SIZE for page in replies)
+    return complete, stub.throttled, min(limits)
+
+
+def mixed_latencies(fast: float, slow: float, pages: int, workers: int) -> float:
+    """Fetch one page that takes `fast` seconds, then `pages` that take `slow`.
+
+    Returns how many requests at once the client allows at the end.
+    """
+    client = Client(max_per_host=workers)
+    with StubServer(make_story(pages * PAGE_SIZE + 1), fast) as stub:
+        client.get_json(f"{stub.url}/api/v1/posts/1")
+        stub.latency = slow
+        urls = [
+            f"{stub.url}/api/v1/posts/1/replies?page={i:d}"
+            for i in range(1, pages + 1)
+        ]
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(client.get_json, urls))
+        client.close()
+    (host,) = client._hosts.values()
+    return host.limit
+
+
+def retry_wait(retry_after: float) -> float:
+    """Seconds between a request answered with `retry_after` and its retry."""
+    client = Client()
+    with StubServer(make_story(2), fail_every=2, retry_after=retry_after) as stub:
+        client.get_json(f"{stub.url}/api/v1/posts/1")
+        client.get_json(f"{stub.url}/api/v1/posts/1/replies?page=1")
+        client.close()
+        return stub.arrivals[2] - stub.arrivals[1]
+
+
+def smarten_mismatches(posts: int, mixes: int, seed: int = 0) -> list[str]:
+    """Texts that `smarten` and smartypants (quotes and dashes) change differently.
+
+    The texts are the posts of a synthetic story of `posts` posts, the
+    pathological posts of `make_adversarial`, `_EDGE_CASES`, and `mixes` random
+    strings of up to 12 of `_PIECES`.
+    """
+    rng = random.Random(seed)
+    texts = [post["content"] for post in make_story(posts, seed)["posts"]]
+    texts += make_adversarial(200).values()
+    texts += _EDGE_CASES
+    texts += (
+        "".join(rng.choices(_PIECES, k=rng.randint(1, 12))) for _ in range(mixes)
+    )
+    return [t for t in texts if smarten(t) != smartypants(t, Attr.q | Attr.d)]
@@ -0,0 +1,293 @@
+"""Time each stage of the pipeline on synthetic stories and report as JSON.
+
+    python -m benchmarks.run --sizes 100,1000,10000 --output bench.json
+
+Each result records the best of `--repeat` runs, so that two reports (say, from
+two versions of the code) can be compared entry by entry.
+"""
+import argparse
+from contextlib import contextmanager
+import datetime
+import json
+import os
+from pathlib import Path
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from typing import Any, Callable, Iterator
+
+import lxml.html
+
+from glowfic_scrape import (
+    download_images,
+    download_thread,
+    epub,
+    story_file,
+    to_html,
+)
+from glowfic_scrape.common_types import Story
+from glowfic_scrape.http_client import CLIENT
+from glowfic_scrape.icon_store import IconStore
+from glowfic_scrape.smartypants import Attr, smartypants
+from glowfic_scrape.typography import smarten, smarten_tree
+
+from .stub import StubServer
+from .synthetic import make_adversarial, make_story
+
+Result = dict[str, Any]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--sizes",
+        default="100,1000,10000",
+        help="comma-separated story sizes in posts (default: %(default)s)",
+    )
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0.005,
+        help="seconds the stub server waits before each response",
+    )
+    parser.add_argument(
+        "--network-posts",
+        type=int,
+        default=1000,
+        help="largest story size used for the download benchmarks",
+    )
+    parser.add_argument(
+        "--adversarial-lengths",
+        default="10000,100000",
+        help="comma-separated lengths in characters of the pathological posts "
+        "rendered; render time should grow linearly (default: %(default)s)",
+    )
+    parser.add_argument("--output", type=Path, help="write the report here")
+    args = parser.parse_args()
+
+    results: list[Result] = []
+    for size in (int(s) for s in args.sizes.split(",")):
+        story = make_story(size)
+        results += bench_render(story, args.repeat)
+        results += bench_files(story, args.repeat)
+        if size <= args.network_posts:
+            results += bench_downloads(size, args.latency)
+    for length in (int(s) for s in args.adversarial_lengths.split(",")):
+        results += bench_adversarial(length, args.repeat)
+    report = {
+        "created": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": results,
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        args.output.write_text(text + "\n")
+    else:
+        print(text)
+
+
+def bench_render(story: Story, repeat: int) -> list[Result]:
+    contents = [post["content"] for post in story["posts"]]
+    stages: dict[str, Callable[[], object]] = {
+        "smartypants": lambda: [smartypants(c, Attr.q | Attr.d) for c in contents],
+        "smarten": lambda: [smarten(c) for c in contents],
+        "lxml_parse": lambda: [_parse(c) for c in contents],
+        "smarten_tree": lambda: [smarten_tree(_parse(c)) for c in contents],
+        "render_content": lambda: [to_html.render_content(c) for c in contents],
+    }
+    results = [_time(name, len(contents), repeat, fn) for name, fn in stages.items()]
+    # both change the trees they are given, so each repetition gets fresh ones
+    trees: list[lxml.html.HtmlElement] = []
+
+    def smartened() -> None:
+        trees[:] = [_parse(c) for c in contents]
+        for tree in trees:
+            smarten_tree(tree)
+
+    def paragraphs() -> None:
+        smartened()
+        for content, tree in zip(contents, trees):
+            if "<p>" not in content and "<details>" not in content:
+                to_html.to_paragraphs(tree)
+
+    results.append(
+        _time(
+            "to_paragraphs",
+            len(contents),
+            repeat,
+            lambda: [to_html.to_paragraphs(t) for t in trees],
+            setup=smartened,
+        )
+    )
+    results.append(
+        _time(
+            "clean_html",
+            len(contents),
+            repeat,
+            lambda: [to_html.clean_html(t) for t in trees],
+            setup=paragraphs,
+        )
+    )
+    return results
+
+
+def bench_adversarial(length: int, repeat: int) -> list[Result]:
+    results = []
+    for kind, content in make_adversarial(length).items():
+        stages: dict[str, Callable[[], object]] = {
+            "smarten": lambda: smarten(content),
+            "render_content": lambda: to_html.render_content(content),
+        }
+        for name, fn in stages.items():
+            results.append(
+                _time(f"{name}[{kind}]", 1, repeat, fn, chars=len(content))
+            )
+    return results
+
+
+def bench_files(story: Story, repeat: int) -> list[Result]:
+    with _scratch_dir() as tmp:
+        json_path = tmp / "story.json"
+        jsonl_path = tmp / "story.jsonl"
+        stages: dict[str, Callable[[], object]] = {
+            "json_dump": lambda: story_file.write_story(story, json_path),
+            "jsonl_dump": lambda: story_file.write_story(story, jsonl_path),
+            "json_load": lambda: json.loads(json_path.read_text()),
+            "read_story.json": lambda: list(story_file.read_story(json_path)[1]),
+            "read_story.jsonl": lambda: list(story_file.read_story(jsonl_path)[1]),
+            "load_compact.json": lambda: story_file.load_compact(json_path),
+            "to_html.process": lambda: to_html.process(str(json_path)),
+            "write_epub": lambda: epub.write_epub(
+                *story_file.read_story(json_path), tmp / "story.epub"
+            ),
+        }
+        n = len(story["posts"])
+        return [_time(name, n, repeat, fn) for name, fn in stages.items()]
+
+
+def bench_downloads(size: int, latency: float) -> list[Result]:
+    results = []
+    with StubServer(make_story(size), latency) as stub, _scratch_dir() as tmp:
+        stub.story = make_story(size, icon_root=f"{stub.url}/icons")
+        api_root = download_thread.API_ROOT
+        download_thread.API_ROOT = f"{stub.url}/api/v1"
+        try:
+            for workers in (1, 8):
+                results.append(
+                    _time(
+                        f"download_thread.proc[workers={workers}]",
+                        size,
+                        1,
+                        lambda: download_thread.proc(1, workers),
+                        latency=latency,
+                    )
+                )
+            # the first run fills the cache, the best one is all revalidation
+            with CLIENT.caching(tmp / "http-cache.sqlite"):
+                results.append(
+                    _time(
+                        "download_thread.proc[revalidate]",
+                        size,
+                        2,
+                        lambda: download_thread.proc(1, 8),
+                        latency=latency,
+                    )
+                )
+        finally:
+            download_thread.API_ROOT = api_root
+        path = tmp / "story.json"
+        story_file.write_story(stub.story, path)
+        results.append(
+            _time(
+                "download_images.process",
+                size,
+                1,
+                lambda: download_images.process(path),
+                latency=latency,
+            )
+        )
+        # the first run fills the store, the best one links every icon from it
+        with IconStore(tmp / "icon-store") as store:
+
+            def from_store() -> None:
+                shutil.rmtree(download_images.SUBDIR, ignore_errors=True)
+                download_images.process(path, store=store)
+
+            results.append(
+                _time(
+                    "download_images.process[icon_store]",
+                    size,
+                    2,
+                    from_store,
+                    latency=latency,
+                )
+            )
+    # a server that allows two requests at a time and fails every 20th one
+    throttling = StubServer(make_story(size), latency, max_concurrent=2, fail_every=20)
+    with throttling as stub:
+        api_root = download_thread.API_ROOT
+        download_thread.API_ROOT = f"{stub.url}/api/v1"
+        try:
+            result = _time(
+                "download_thread.proc[throttled]",
+                size,
+                1,
+                lambda: download_thread.proc(1, 8),
+                latency=latency,
+            )
+        finally:
+            download_thread.API_ROOT = api_root
+        result.update(requests=stub.requests, throttled=stub.throttled)
+        results.append(result)
+    return results
+
+
+def _parse(content: str) -> lxml.html.HtmlElement:
+    return lxml.html.fragment_fromstring(content, create_parent="post")
+
+
+def _time(
+    name: str,
+    posts: int,
+    repeat: int,
+    fn: Callable[[], object],
+    setup: Callable[[], object] | None = None,
+    **extra: Any,
+) -> Result:
+    """The best time of `repeat` calls of `fn`, each after an untimed `setup`."""
+    best = float("inf")
+    stderr = sys.stderr
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        sys.stderr = open(os.devnull, "w")
+        try:
+            start = time.perf_counter()
+            fn()
+            best = min(best, time.perf_counter() - start)
+        finally:
+            sys.stderr.close()
+            sys.stderr = stderr
+    result = {"benchmark": name, "posts": posts, "seconds": best, **extra}
+    stderr.write(f"{name:40} {posts:7d} posts {best:9.4f} s\n")
+    return result
+
+
+@contextmanager
+def _scratch_dir() -> Iterator[Path]:
+    """A temporary working directory, as the commands write into the current one."""
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        try:
+            yield Path(tmp)
+        finally:
+            os.chdir(cwd)
+
+
+if __name__ == "__main__":
+    main()
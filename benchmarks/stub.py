@@ -0,0 +1,158 @@
+"""A local stand-in for the glowfic API and its icon hosts, with injected latency."""
+import hashlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import re
+import threading
+import time
+from typing import Any, Final
+
+from glowfic_scrape.common_types import PostInfo, Story
+
+__all__ = ["StubServer"]
+
+PAGE_SIZE: Final = 25
+ICON_BYTES: Final = bytes(range(256)) * 64
+
+_THREAD: Final = re.compile(r"/api/v1/posts/(\d+)$")
+_REPLIES: Final = re.compile(r"/api/v1/posts/(\d+)/replies\?page=(\d+)$")
+_ICON: Final = re.compile(r"/icons/\d+\.png$")
+
+
+class StubServer:
+    """Serve one story as thread 1 on a local port, in a background thread.
+
+    Every response is delayed by `latency` seconds.  Like a server that throttles
+    its clients, the stub answers 429 with a ``Retry-After`` of `retry_after`
+    seconds to requests beyond `max_concurrent` in flight, and 503 to every
+    `fail_every`-th request.  Responses carry an ``ETag``, and a request with a
+    matching ``If-None-Match`` gets ``304 Not Modified``.  `arrivals` holds the
+    `time.monotonic` at which each request arrived.
+    """
+
+    def __init__(
+        self,
+        story: Story,
+        latency: float = 0.0,
+        max_concurrent: int | None = None,
+        retry_after: float = 0.0,
+        fail_every: int = 0,
+    ) -> None:
+        self.story = story
+        self.latency = latency
+        self.max_concurrent = max_concurrent
+        self.retry_after = retry_after
+        self.fail_every = fail_every
+        self.requests = 0
+        self.throttled = 0
+        self.not_modified = 0
+        self.arrivals: list[float] = []
+        self._in_flight = 0
+        self._lock = threading.Lock()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self) -> None:
+                with stub._lock:
+                    stub.requests += 1
+                    stub.arrivals.append(time.monotonic())
+                    stub._in_flight += 1
+                    status = stub._throttle()
+                try:
+                    time.sleep(stub.latency)
+                    if status:
+                        self.send_response(status)
+                        self.send_header("Retry-After", f"{stub.retry_after:g}")
+                        self.send_header("Content-Length", "0")
+                        self.end_headers()
+                        return
+                    self.send_story()
+                finally:
+                    with stub._lock:
+                        stub._in_flight -= 1
+
+            def send_story(self) -> None:
+                body = stub.respond(self.path)
+                if body is None:
+                    self.send_response(404)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                etag = '"%s"' % hashlib.sha1(body).hexdigest()
+                if self.headers.get("If-None-Match") == etag:
+                    with stub._lock:
+                        stub.not_modified += 1
+                    self.send_response(304)
+                    self.send_header("ETag", etag)
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header("ETag", etag)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format: str, *args: Any) -> None:
+                pass
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self._server.server_port:d}"
+
+    def __enter__(self) -> "StubServer":
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc: object) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _throttle(self) -> int:
+        """The error status to answer the current request with, or 0."""
+        if self.fail_every and self.requests % self.fail_every == 0:
+            self.throttled += 1
+            return 503
+        if self.max_concurrent is not None and self._in_flight > self.max_concurrent:
+            self.throttled += 1
+            return 429
+        return 0
+
+    def respond(self, path: str) -> bytes | None:
+        posts = self.story["posts"]
+        if _ICON.match(path):
+            return ICON_BYTES
+        if m := _THREAD.match(path):
+            thread = _raw_post(posts[0])
+            thread.update(
+                authors=[thread["user"]],
+                num_replies=len(posts) - 1,
+                subject=self.story["title"],
+            )
+            return json.dumps(thread).encode()
+        if m := _REPLIES.match(path):
+            start = 1 + (int(m.group(2)) - 1) * PAGE_SIZE
+            page = posts[start : start + PAGE_SIZE]
+            return json.dumps([_raw_post(p) for p in page]).encode()
+        return None
+
+
+def _raw_post(post: PostInfo) -> dict[str, Any]:
+    raw: dict[str, Any] = {
+        "id": post["id"],
+        "content": post["content"],
+        "created_at": post["posted"],
+        "user": {
+            "id": int(post["author_url"].rsplit("/", 1)[1]),
+            "username": post["author"],
+        },
+    }
+    if "character" in post and "character_url" in post:
+        raw["character"] = {
+            "id": int(post["character_url"].rsplit("/", 1)[1]),
+            "name": post["character"],
+        }
+    if "icon_url" in post:
+        raw["icon"] = {"id": 1, "url": post["icon_url"], "keyword": "icon"}
+    return raw
@@ -0,0 +1,102 @@
+"""Synthetic glowfic stories for benchmarking.
+
+The post content imitates what the glowfic API returns: paragraphs either as
+``<p>`` elements or separated by ``<br>`` tags, the odd ``<details>`` spoiler,
+relative links, and plenty of straight quotes and dashes.  `make_adversarial`
+makes posts that once took quadratic time to render.
+"""
+import random
+from typing import Final
+
+from glowfic_scrape.common_types import HtmlCode, PostInfo, Story, Url
+
+__all__ = ["make_story", "make_content", "make_adversarial", "ICON_COUNT"]
+
+ICON_COUNT: Final = 40
+
+_WORDS: Final = (
+    "the a of and to in is it that was he she they said not what if could would "
+    "Carissa Keltham Asmodeus Golarion dath ilan probability prediction market "
+    "spell cleric wizard Cheliax contract tomorrow question answer maybe obviously"
+).split()
+_AUTHORS: Final = ["lintamande", "Iarwain", "Alicorn", "Aestrix", "Throne3d"]
+_CHARACTERS: Final = ["Keltham", "Carissa Sevar", "Asmodia", "Pilar", "Meritxell"]
+
+
+def make_story(
+    num_posts: int, seed: int = 0, icon_root: str = "https://example.com/icons"
+) -> Story:
+    rng = random.Random(seed)
+    posts = [_make_post(rng, i, icon_root) for i in range(num_posts)]
+    return {
+        "title": f"Synthetic story with {num_posts} posts",
+        "authors": " & ".join(_AUTHORS[:2]),
+        "comments": Url("https://www.glowfic.com/posts/1"),
+        "posts": posts,
+    }
+
+
+def make_content(rng: random.Random) -> HtmlCode:
+    paragraphs = [_sentence(rng) for _ in range(rng.randint(1, 6))]
+    if rng.random() < 0.05:
+        paragraphs.append(
+            f"<details><summary>{_sentence(rng)}</summary>{_sentence(rng)}</details>"
+        )
+    if rng.random() < 0.5:
+        return HtmlCode("".join(f"<p>{p}</p>" for p in paragraphs))
+    return HtmlCode("<br><br>".join(paragraphs))
+
+
+def make_adversarial(length: int) -> dict[str, HtmlCode]:
+    """Pathological post contents of about `length` characters, by kind."""
+    return {
+        "unclosed_comments": HtmlCode("<!-- a> " * (length // 8)),
+        "unclosed_comment": HtmlCode("<!-- " + "x -" * (length // 3)),
+        "br_run": HtmlCode("a" + "<br>" * (length // 4) + "b"),
+        "br_lines": HtmlCode("line<br>" * (length // 8)),
+        "newline_lines": HtmlCode("line\n" * (length // 5)),
+        "space_run": HtmlCode("a" + " " * length + "b"),
+        "quote_run": HtmlCode("\"'" * (length // 2)),
+        "dash_run": HtmlCode("a" + " -" * (length // 2)),
+    }
+
+
+def _make_post(rng: random.Random, index: int, icon_root: str) -> PostInfo:
+    author = rng.randrange(len(_AUTHORS))
+    character = rng.randrange(len(_CHARACTERS) + 1)
+    post: PostInfo = {
+        "id": index + 1,
+        "author": _AUTHORS[author],
+        "author_url": Url(f"https://www.glowfic.com/users/{author + 1:d}"),
+        "content": make_content(rng),
+        "permalink": Url(f"https://www.glowfic.com/replies/{index:d}#reply-{index:d}"),
+        "posted": "2021-09-01T12:00:00.000Z",
+    }
+    if character < len(_CHARACTERS):
+        post["character"] = _CHARACTERS[character]
+        post["character_url"] = Url(
+            f"https://www.glowfic.com/characters/{character + 1:d}"
+        )
+        post["icon_url"] = Url(f"{icon_root}/{rng.randrange(ICON_COUNT):d}.png")
+    return post
+
+
+def _sentence(rng: random.Random) -> str:
+    words = rng.choices(_WORDS, k=rng.randint(4, 40))
+    for _ in range(rng.randint(0, 3)):
+        i = rng.randrange(len(words))
+        kind = rng.random()
+        if kind < 0.3:
+            words[i] = f'"{words[i]}'
+            words[-1] = f'{words[-1]}"'
+        elif kind < 0.5:
+            words[i] = f"{words[i]}'s"
+        elif kind < 0.6:
+            words[i] = f"'{words[i]}'"
+        elif kind < 0.75:
+            words[i] = f"{words[i]} -"
+        elif kind < 0.85:
+            words[i] = f'<a href="/posts/{rng.randint(1, 9999)}">{words[i]}</a>'
+        else:
+            words[i] = f"<i>{words[i]}</i>"
+    return " ".join(words).capitalize() + rng.choice([".", "?", "!", "...", "--"])
@@ -2,7 +2,7 @@ import hashlib
 from typing import NewType, TypedDict
 from typing_extensions import NotRequired
 
-__all__ = ["Url", "HtmlCode", "Story", "PostInfo", "get_image_filename"]
+__all__ = ["Url", "HtmlCode", "Story", "StoryHeader", "PostInfo", "get_image_filename"]
 
 Url = NewType("Url", str)
 HtmlCode = NewType("HtmlCode", str)
@@ -22,10 +22,13 @@ class PostInfo(TypedDict):
     icon_url: NotRequired[Url]
 
 
-class Story(TypedDict):
+class StoryHeader(TypedDict):
     title: str
     authors: str
     comments: Url
+
+
+class Story(StoryHeader):
     posts: list[PostInfo]
 
 
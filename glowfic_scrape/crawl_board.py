@@ -0,0 +1,227 @@
+"""Download every thread in a board, or in some of its sections.
+
+The threads are listed through the API, downloaded several at a time with
+`download_thread.batch`, and written to one story file each, next to a
+``manifest.json`` that lists the threads and their files.  Running the crawler
+again on the same directory only syncs the threads it already has.
+"""
+import argparse
+import datetime
+import json
+from pathlib import Path
+import sys
+import time
+from typing import Any, Final, TypedDict
+from typing_extensions import NotRequired
+
+from . import download_thread
+from .common_types import Url
+from .http_client import add_client_arguments, configured
+from .metrics import add_metrics_argument, recording
+from .progress import Outcome, summarize
+from .story_file import write_json
+
+MANIFEST: Final = "manifest.json"
+LISTING_CACHE: Final = ".listing.json"
+LISTING_MAX_AGE: Final = 3600.0
+"""Seconds for which a board listing is reused instead of fetched again."""
+
+
+class SectionInfo(TypedDict):
+    id: int
+    name: str
+
+
+class ListedThread(TypedDict):
+    """A thread as it appears in a board listing."""
+
+    id: int
+    subject: str
+    section: NotRequired[SectionInfo | None]
+
+
+class ThreadEntry(TypedDict):
+    id: int
+    subject: str
+    section: str | None
+    file: str | None
+    error: NotRequired[str]
+
+
+class Manifest(TypedDict):
+    board: int
+    name: str
+    sections: list[int]
+    crawled: str
+    threads: list[ThreadEntry]
+
+
+def list_threads(
+    board: int, cache: Path | None = None, max_age: float = LISTING_MAX_AGE
+) -> tuple[str, list[ListedThread]]:
+    """Return the name of a board and the threads in it.
+
+    With `cache`, the listing pages are kept in that file and reused for
+    `max_age` seconds.
+    """
+    if cache is not None and cache.exists():
+        cached = json.loads(cache.read_text())
+        if cached["board"] == board and time.time() - cached["fetched"] < max_age:
+            return cached["name"], [t for page in cached["pages"] for t in page]
+
+    info: dict[str, Any] = download_thread.get_json(
+        Url(f"{download_thread.API_ROOT}/boards/{board:d}")
+    )
+    fetched = time.time()
+    pages: list[list[ListedThread]] = []
+    while True:
+        data = download_thread.get_json(_listing_url(board, len(pages) + 1))
+        page: list[ListedThread] = data["results"] if isinstance(data, dict) else data
+        if not page:
+            break
+        pages.append(page)
+        if len(page) < len(pages[0]):
+            break
+    if cache is not None:
+        listing = {"board": board, "name": info["name"], "fetched": fetched}
+        write_json({**listing, "pages": pages}, cache)
+    return info["name"], [t for page in pages for t in page]
+
+
+def _listing_url(board: int, page: int) -> Url:
+    return Url(f"{download_thread.API_ROOT}/boards/{board:d}/posts?page={page:d}")
+
+
+def crawl(
+    board: int,
+    out_dir: Path,
+    sections: list[int] | None = None,
+    workers: int = 1,
+    jsonl: bool = False,
+    parallel: int = 1,
+    max_age: float = LISTING_MAX_AGE,
+) -> tuple[Manifest, list[Outcome]]:
+    """Download the threads of `board` (only those in `sections`, if given).
+
+    Threads listed in an existing manifest in `out_dir` are synced rather than
+    downloaded again.  Writes the manifest and returns it with the outcome of
+    each download.
+    """
+    out_dir.mkdir(parents=True, exist_ok=True)
+    name, threads = list_threads(board, out_dir / LISTING_CACHE, max_age)
+    # a thread bumped while the listing was fetched can appear on two pages
+    unique: dict[int, ListedThread] = {}
+    for t in threads:
+        unique.setdefault(t["id"], t)
+    threads = list(unique.values())
+    if sections:
+        threads = [t for t in threads if _section_id(t) in sections]
+
+    have: dict[int, Path] = {}
+    manifest_path = out_dir / MANIFEST
+    if manifest_path.exists():
+        old: Manifest = json.loads(manifest_path.read_text())
+        for entry in old["threads"]:
+            if entry["file"] and (out_dir / entry["file"]).exists():
+                have[entry["id"]] = out_dir / entry["file"]
+
+    new = [t["id"] for t in threads if t["id"] not in have]
+    known = [t["id"] for t in threads if t["id"] in have]
+    outcomes = download_thread.batch(
+        new, [have[i] for i in known], workers, jsonl, parallel, out_dir
+    )
+    results = dict(zip(new + known, outcomes))
+
+    entries: list[ThreadEntry] = []
+    for t in threads:
+        outcome = results[t["id"]]
+        path = outcome.path or have.get(t["id"])
+        section = t.get("section")
+        entry: ThreadEntry = {
+            "id": t["id"],
+            "subject": t["subject"],
+            "section": section["name"] if section else None,
+            "file": path.name if path else None,
+        }
+        if outcome.error is not None:
+            entry["error"] = outcome.error
+        entries.append(entry)
+    manifest: Manifest = {
+        "board": board,
+        "name": name,
+        "sections": sections or [],
+        "crawled": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "threads": entries,
+    }
+    write_json(manifest, manifest_path)
+    return manifest, outcomes
+
+
+def _section_id(thread: ListedThread) -> int | None:
+    section = thread.get("section")
+    return section["id"] if section else None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("board", type=int)
+    parser.add_argument(
+        "-o",
+        "--out-dir",
+        type=Path,
+        help="where to put the stories and the manifest (default: board_<id>)",
+    )
+    parser.add_argument(
+        "-s",
+        "--section",
+        type=int,
+        action="append",
+        dest="sections",
+        metavar="SECTION",
+        help="only download threads in this section; can be repeated",
+    )
+    parser.add_argument(
+        "-j",
+        "--workers",
+        type=int,
+        default=1,
+        help="number of reply pages to fetch concurrently per thread",
+    )
+    parser.add_argument(
+        "-p",
+        "--parallel",
+        type=int,
+        default=4,
+        help="number of threads to download at once (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--jsonl",
+        action="store_true",
+        help="write stories as JSON Lines, one post per line",
+    )
+    parser.add_argument(
+        "--listing-max-age",
+        type=float,
+        default=LISTING_MAX_AGE,
+        help="seconds for which to reuse a cached board listing "
+        "(default: %(default)s)",
+    )
+    add_client_arguments(parser)
+    add_metrics_argument(parser)
+    args = parser.parse_args()
+    start = time.monotonic()
+    with recording(args.metrics), configured(args):
+        manifest, outcomes = crawl(
+            args.board,
+            args.out_dir or Path(f"board_{args.board:d}"),
+            args.sections,
+            args.workers,
+            args.jsonl,
+            args.parallel,
+            args.listing_max_age,
+        )
+    sys.stderr.write(
+        '%d threads in "%s".\n' % (len(manifest["threads"]), manifest["name"])
+    )
+    if not summarize(outcomes, time.monotonic() - start):
+        sys.exit(1)
@@ -1,45 +1,167 @@
-import json
+import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import ExitStack
 from pathlib import Path
+import sqlite3
 import sys
 from typing import Final
-from urllib.request import urlopen
-from urllib.error import URLError
 
-from .common_types import Story, Url, get_image_filename
+from .common_types import Url, get_image_filename
+from .http_client import CLIENT, add_client_arguments, configured
+from .icon_store import DEFAULT_MAX_BYTES, IconStore, default_path, link
+from .icons import ICON_SIZE, QUALITY, normalize
+from .metrics import METRICS, add_metrics_argument, recording
+from .story_file import read_story
 
 SUBDIR: Final = "images"
+WORKERS: Final = 8
 
 
 def main() -> None:
-    for arg in sys.argv[1:]:
-        process(Path(arg))
+    parser = argparse.ArgumentParser(description="Download the icons of stories.")
+    parser.add_argument("stories", nargs="+", type=Path, metavar="story")
+    parser.add_argument(
+        "-j",
+        "--workers",
+        type=int,
+        default=WORKERS,
+        help="number of icons to download concurrently",
+    )
+    parser.add_argument(
+        "--icon-size",
+        type=int,
+        default=ICON_SIZE,
+        metavar="PIXELS",
+        help="shrink icons to at most this wide and high, if Pillow is installed; "
+        "0 to keep them as they are (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--quality",
+        type=int,
+        default=QUALITY,
+        help="JPEG quality of shrunk icons (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--processes",
+        type=int,
+        help="number of processes to shrink icons with (default: one per CPU)",
+    )
+    parser.add_argument(
+        "--icon-store",
+        type=Path,
+        nargs="?",
+        const=default_path(),
+        metavar="DIR",
+        help="keep icons once in this store shared by all stories, and link them "
+        "into images from there (default DIR: %(const)s)",
+    )
+    parser.add_argument(
+        "--icon-store-max-bytes",
+        type=int,
+        default=DEFAULT_MAX_BYTES,
+        metavar="N",
+        help="evict the least recently used icons from the store beyond this "
+        "size (default: %(default)s)",
+    )
+    add_client_arguments(parser, limits=False)
+    add_metrics_argument(parser)
+    args = parser.parse_args()
+    failed = 0
+    names = []
+    with recording(args.metrics):
+        with ExitStack() as stack:
+            stack.enter_context(configured(args))
+            store = None
+            if args.icon_store is not None:
+                store = stack.enter_context(
+                    IconStore(args.icon_store, args.icon_store_max_bytes)
+                )
+            for path in args.stories:
+                for url, error in process(path, args.workers, store).items():
+                    if error is not None:
+                        failed += 1
+                        sys.stderr.write(f"{error}\n")
+                    else:
+                        names.append(get_image_filename(url))
+        with METRICS.timer("icons.normalize"):
+            normalize(
+                Path(SUBDIR), names, args.icon_size, args.quality, args.processes
+            )
+    if failed:
+        sys.exit(f"{failed} icons could not be downloaded.")
 
 
-def process(filepath: Path) -> None:
+def process(
+    filepath: Path, workers: int = WORKERS, store: IconStore | None = None
+) -> dict[Url, str | None]:
+    """Download the icons used in a story into the `images` directory.
+
+    Every icon URL is fetched at most once, with up to `workers` downloads running
+    concurrently.  Icons in `store` are linked from there instead, and downloaded
+    ones are added to it.  Returns for each URL `None` if the icon is there, or
+    the reason it could not be downloaded.
+    """
     dir = Path(".") / SUBDIR
     dir.mkdir(exist_ok=True, parents=True)
-    with filepath.open("r") as f:
-        thread: Story = json.load(f)
-    total = len(thread["posts"])
+    _, posts = read_story(filepath)
+    urls = list(dict.fromkeys(p["icon_url"] for p in posts if "icon_url" in p))
+    results: dict[Url, str | None] = {}
+    total = len(urls)
     percent = 0
-    for i, post in enumerate(thread["posts"], start=1):
-        if "icon_url" in post:
-            download_image(post["icon_url"], dir)
-        p = 100 * i // total
-        if p != percent:
-            percent = p
-            sys.stderr.write("\r%3d %% " % percent)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(download_image, url, dir, store): url for url in urls}
+        for i, future in enumerate(as_completed(futures), start=1):
+            try:
+                future.result()
+            except Exception as e:  # one bad icon doesn't stop the others
+                results[futures[future]] = failure_reason(e)
+            else:
+                results[futures[future]] = None
+            p = 100 * i // total
+            if p != percent:
+                percent = p
+                sys.stderr.write("\r%3d %% " % percent)
+    sys.stderr.write("\r       \r")
+    return {url: results[url] for url in urls}
+
+
+def failure_reason(e: Exception) -> str:
+    """What to report for an icon that `download_image` failed on with `e`."""
+    if e.__cause__ is not None:
+        return f"{e} ({e.__cause__})"
+    return str(e) or repr(e)
+
 
+def download_image(url: Url, dir: Path, store: IconStore | None = None) -> None:
+    """Download an icon into `dir`, or link it from `store`.
 
-def download_image(url: Url, dir: Path) -> None:
+    Raises `RuntimeError` if the icon can't be downloaded or saved.
+    """
     filename = dir / get_image_filename(url)
-    if not filename.exists():
-        try:
-            connection = urlopen(url, timeout=10)  # 10 second time out
-        except URLError as e:
-            raise RuntimeError(f"Can't open: '{url}' for '{filename}'.") from e
-        with filename.open("wb") as f:
-            f.write(connection.read())
+    if filename.exists():
+        METRICS.count("icons.present")
+        return
+    try:
+        blob = store.lookup(url) if store is not None else None
+        if blob is None:
+            try:
+                response = CLIENT.get(url, timeout=10)  # 10 second time out
+            except (OSError, ValueError) as e:
+                METRICS.count("icons.failed")
+                raise RuntimeError(f"Can't open: '{url}' for '{filename}'.") from e
+            METRICS.count("icons.downloaded")
+            METRICS.count("icons.bytes", len(response.body))
+            if store is None:
+                with filename.open("wb") as f:
+                    f.write(response.body)
+                return
+            blob = store.add(url, response.body)
+        else:
+            METRICS.count("icons.from_store")
+        link(blob, filename)
+    except (OSError, sqlite3.Error) as e:
+        METRICS.count("icons.failed")
+        raise RuntimeError(f"Can't save: '{url}' as '{filename}'.") from e
 
 
 if __name__ == "__main__":
@@ -1,15 +1,50 @@
-import json
+import argparse
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import cache, partial
+from itertools import islice
+from pathlib import Path
 import re
 import sys
-from typing import Any, TypedDict
+import time
+from typing import Any, Callable, Final, Iterable, Iterator, TypedDict
 from typing_extensions import NotRequired
-from urllib.request import urlopen
 
-from .common_types import HtmlCode, PostInfo, Story, Url
+from .common_types import HtmlCode, PostInfo, Story, StoryHeader, Url
+from .http_client import CLIENT, add_client_arguments, configured
+from .metrics import METRICS, add_metrics_argument, recording
+from .progress import Outcome, Progress, summarize
+from .records import CompactStory
+from .story_file import (
+    append_jsonl,
+    append_posts,
+    create_jsonl,
+    is_jsonl,
+    load_compact,
+    read_story,
+    write_story,
+)
+from .story_store import (
+    STORE_SUFFIXES,
+    StoryStore,
+    is_store_path,
+    split_store_path,
+    store_path,
+)
+
+API_ROOT = "https://www.glowfic.com/api/v1"
+"""Where the glowfic API lives; can be pointed at a mirror or a local stand-in."""
+
+CHECKPOINT_PAGES: Final = 20
+"""How many pages `sync` fetches between writes of the story file."""
+STORE_CHUNK: Final = 100
+"""How many posts `main` writes to a story store per transaction."""
+PAGES_AHEAD: Final = 2
+"""How many pages per worker `iter_reply_pages` fetches ahead of its consumer."""
 
 
 def get_json(url: Url) -> Any:
-    return json.load(urlopen(url))
+    return CLIENT.get_json(url)
 
 
 class UserInfo(TypedDict):
@@ -49,46 +84,106 @@ class RawPost(TypedDict):
     icon: NotRequired[IconInfo]
 
 
-def proc(main_post: int) -> Story:
+def proc(main_post: int, workers: int = 1) -> Story:
+    header, posts = iter_thread(main_post, workers)
+    return {**header, "posts": list(posts)}
+
+
+def iter_thread(
+    main_post: int, workers: int = 1, progress: Progress | None = None
+) -> tuple[StoryHeader, Iterator[PostInfo]]:
+    """Fetch the header of a thread and return it with an iterator over its posts.
+
+    The replies are fetched as the iterator is consumed.
+    """
     comments_url = Url(f"https://www.glowfic.com/posts/{main_post:d}")
-    main_url = Url(f"https://www.glowfic.com/api/v1/posts/{main_post:d}")
+    main_url = Url(f"{API_ROOT}/posts/{main_post:d}")
     thread: ThreadInfo = get_json(main_url)
-    title: str = thread["subject"]
-    authors = " & ".join(a["username"] for a in thread["authors"])
-    num_replies = thread["num_replies"]
+    header: StoryHeader = {
+        "title": thread["subject"],
+        "authors": " & ".join(a["username"] for a in thread["authors"]),
+        "comments": comments_url,
+    }
+    return header, _iter_posts(thread, workers, progress or Progress())
+
 
+def _iter_posts(
+    thread: ThreadInfo, workers: int, progress: Progress
+) -> Iterator[PostInfo]:
+    main_post = thread["id"]
+    num_replies = thread["num_replies"]
     permalink = Url(f"https://www.glowfic.com/posts/{main_post:d}")
+    METRICS.count("download.posts")
+    yield _dopost(thread, permalink, thread["authors"][0])
+
+    job = str(main_post)
+    count = 1
+    try:
+        for posts in iter_reply_pages(main_post, num_replies, workers):
+            METRICS.count("download.pages")
+            METRICS.count("download.posts", len(posts))
+            for post in posts:
+                yield _doreply(post)
+                count += 1
+                progress.update(job, 100 * count // max(num_replies, 1))
+    finally:
+        progress.finish(job)
+
 
-    all_posts: list[PostInfo] = []
-    all_posts.append(_dopost(thread, permalink, thread["authors"][0]))
+def iter_reply_pages(
+    main_post: int, num_replies: int, workers: int = 1, start: int = 1, page_size: int = 0
+) -> Iterator[list[RawPost]]:
+    """Yield the pages of replies to a thread, in order, beginning with `start`.
 
-    index = 1
-    percent = 0
+    With more than one worker, the page size and `num_replies` are used to work out
+    how many pages there are, and those are fetched concurrently, no more than
+    `PAGES_AHEAD` per worker ahead of the consumer.  An empty or short page ends
+    the thread early; pages after the computed last one (replies posted
+    in the meantime) are fetched one by one until an empty page.  The page size is
+    taken from the first page fetched unless given.
+    """
+    posts: list[RawPost] = get_json(_replies_url(main_post, start))
+    if not posts:
+        return
+    yield posts
+    page_size = page_size or len(posts)
+    index = start + 1
+    num_pages = -(-num_replies // page_size)
+    if workers > 1 and num_pages >= index:
+        pool = ThreadPoolExecutor(max_workers=workers)
+        pending: deque[Future[list[RawPost]]] = deque()
+        pages = iter(range(index, num_pages + 1))
+        try:
+            while True:
+                for page in islice(pages, workers * PAGES_AHEAD - len(pending)):
+                    pending.append(pool.submit(get_json, _replies_url(main_post, page)))
+                if not pending:
+                    break
+                posts = pending.popleft().result()
+                if not posts:
+                    return
+                yield posts
+                index += 1
+                if len(posts) < page_size:
+                    return
+        finally:
+            pool.shutdown(cancel_futures=True)
     while True:
-        replies_url = Url(
-            f"https://www.glowfic.com/api/v1/posts/{main_post:d}/replies?page={index:d}"
-        )
-        posts: list[RawPost] = get_json(replies_url)
+        posts = get_json(_replies_url(main_post, index))
         index += 1
         if not posts:
             break
-        for post in posts:
-            postid = post["id"]
-            permalink = Url(
-                f"https://www.glowfic.com/replies/{postid:d}#reply-{postid:d}"
-            )
-            all_posts.append(_dopost(post, permalink, post["user"]))
-            p = 100 * len(all_posts) // num_replies
-            if p != percent:
-                percent = p
-                sys.stderr.write("\r%3d %% " % percent)
-    sys.stderr.write("\r       \r")
-    return {
-        "title": title,
-        "authors": authors,
-        "comments": comments_url,
-        "posts": all_posts,
-    }
+        yield posts
+
+
+def _replies_url(main_post: int, page: int) -> Url:
+    return Url(f"{API_ROOT}/posts/{main_post:d}/replies?page={page:d}")
+
+
+def _doreply(post: RawPost) -> PostInfo:
+    postid = post["id"]
+    permalink = Url(f"https://www.glowfic.com/replies/{postid:d}#reply-{postid:d}")
+    return _dopost(post, permalink, post["user"])
 
 
 def _dopost(post: ThreadInfo | RawPost, permalink: Url, author: UserInfo) -> PostInfo:
@@ -96,28 +191,282 @@ def _dopost(post: ThreadInfo | RawPost, permalink: Url, author: UserInfo) -> Pos
         "id": post["id"],
         "permalink": permalink,
         "author": author["username"],
-        "author_url": Url(f"https://www.glowfic.com/users/{author['id']:d}"),
+        "author_url": _user_url(author["id"]),
         "posted": post["created_at"],
         "content": post["content"],
     }
     c = post.get("character")
     if c and "name" in c and "id" in c:
         ret["character"] = c["name"]
-        ret["character_url"] = Url(f"https://www.glowfic.com/characters/{c['id']:d}")
+        ret["character_url"] = _character_url(c["id"])
     i: IconInfo | None = post.get("icon")
     if i is not None:
         ret["icon_url"] = i["url"]
     return ret
 
 
-def main(postid: int):
-    thread = proc(postid)
-    ofilename = re.sub(r"\W+", "_", thread["title"]) + ".json"
-    with open(ofilename, "w") as o:
-        json.dump(thread, o)
-    sys.stderr.write('wrote to "%s".\n' % ofilename)
+# the same few users and characters write most posts; share their URL strings
+@cache
+def _user_url(user: int) -> Url:
+    return Url(f"https://www.glowfic.com/users/{user:d}")
+
+
+@cache
+def _character_url(character: int) -> Url:
+    return Url(f"https://www.glowfic.com/characters/{character:d}")
+
+
+def sync(filepath: Path, workers: int = 1, progress: Progress | None = None) -> int:
+    """Fetch the replies missing from an existing story file and merge them in.
+
+    Only the pages that can hold new replies are fetched; where to resume is worked
+    out from the reply ids already in the story.  A JSON Lines story has the new
+    replies appended page by page, and so does a story in a store.  A JSON story is
+    rewritten atomically every `CHECKPOINT_PAGES` pages and when the sync ends,
+    even if it ends with an error.  Either way an interrupted sync picks up from
+    the last completed page.  Returns the number of new replies.
+    """
+    progress = progress or Progress()
+    if is_store_path(filepath):
+        db, main_post = split_store_path(filepath)
+        new_replies = 0
+        with StoryStore(db) as store:
+            known = store.reply_ids(main_post)
+            for page in _missing_replies(main_post, known, workers, progress):
+                store.add_posts(main_post, page)
+                new_replies += len(page)
+        return new_replies
+
+    if is_jsonl(filepath):
+        _, posts = read_story(filepath)
+        main_post = next(posts)["id"]
+        known = {post["id"] for post in posts}
+        new_replies = 0
+        with append_jsonl(filepath) as o:
+            for page in _missing_replies(main_post, known, workers, progress):
+                append_posts(o, page)
+                o.flush()
+                new_replies += len(page)
+        return new_replies
+
+    story = load_compact(filepath)
+    main_post = story.posts[0].id
+    known = {post.id for post in story.posts[1:]}
+    new_replies = 0
+    try:
+        pages = _missing_replies(main_post, known, workers, progress)
+        for i, page in enumerate(pages, 1):
+            story.extend(page)
+            new_replies += len(page)
+            if i % CHECKPOINT_PAGES == 0:
+                write_story(story.view(), filepath)
+    finally:
+        if new_replies:
+            write_story(story.view(), filepath)
+    return new_replies
+
+
+def _missing_replies(
+    main_post: int, known: set[int], workers: int, progress: Progress
+) -> Iterator[list[PostInfo]]:
+    """Yield, page by page, the replies to a thread whose ids are not in `known`."""
+    main_url = Url(f"{API_ROOT}/posts/{main_post:d}")
+    thread: ThreadInfo = get_json(main_url)
+    num_replies = thread["num_replies"]
+    if not num_replies:
+        return
+
+    first: list[RawPost] = get_json(_replies_url(main_post, 1))
+    page_size = len(first) or 1
+    start = len(known) // page_size + 1
+    if known:
+        # the count of replies can't tell: replies may have been deleted since
+        # the last sync as well as added; the last page can
+        last_known = max(known)
+        num_pages = -(-num_replies // page_size)
+        last = first
+        if num_pages > 1:
+            last = get_json(_replies_url(main_post, num_pages))
+        if last and last[-1]["id"] <= last_known:
+            return
+        # step back until the page starts with a reply we already have
+        while start > 1:
+            page: list[RawPost] = get_json(_replies_url(main_post, start))
+            if page and page[0]["id"] <= last_known:
+                break
+            start -= 1
+
+    job = str(main_post)
+    count = len(known)
+    try:
+        for page in iter_reply_pages(main_post, num_replies, workers, start, page_size):
+            new = [_doreply(post) for post in page if post["id"] not in known]
+            METRICS.count("download.pages")
+            METRICS.count("download.posts", len(new))
+            known.update(post["id"] for post in new)
+            count += len(new)
+            progress.update(job, 100 * count // max(num_replies, 1))
+            if new:
+                yield new
+    finally:
+        progress.finish(job)
+
+
+def main(
+    postid: int,
+    workers: int = 1,
+    jsonl: bool = False,
+    progress: Progress | None = None,
+    out_dir: Path | None = None,
+    store: Path | None = None,
+) -> Path:
+    """Download a thread into a file named after its title, and return the path.
+
+    With `out_dir`, the file goes there and its name starts with the post id, so
+    that threads with the same title get different files.  With `store`, the
+    thread goes into that `story_store` database instead, as the posts arrive.
+    """
+    progress = progress or Progress()
+    header, posts = iter_thread(postid, workers, progress)
+    return save(postid, header, posts, jsonl, progress, out_dir, store)
+
+
+def save(
+    postid: int,
+    header: StoryHeader,
+    posts: Iterable[PostInfo],
+    jsonl: bool = False,
+    progress: Progress | None = None,
+    out_dir: Path | None = None,
+    store: Path | None = None,
+) -> Path:
+    """Write the posts of thread `postid` as they come, where `main` would."""
+    progress = progress or Progress()
+    if store is not None:
+        it = iter(posts)
+        with StoryStore(store) as db:
+            db.put_header(postid, header)
+            while chunk := list(islice(it, STORE_CHUNK)):
+                db.add_posts(postid, chunk)
+        path = store_path(store, postid)
+        progress.log('wrote to "%s".' % path)
+        return path
+    ofilename = re.sub(r"\W+", "_", header["title"]) + (".jsonl" if jsonl else ".json")
+    path = Path(ofilename) if out_dir is None else out_dir / f"{postid:d}_{ofilename}"
+    if jsonl:
+        # written as the posts arrive; an interrupted download can be finished
+        # with --sync
+        with create_jsonl(path, header) as o:
+            for post in posts:
+                append_posts(o, [post])
+    else:
+        write_story(CompactStory(header, posts).view(), path)
+    progress.log('wrote to "%s".' % path)
+    return path
+
+
+def batch(
+    postids: list[int],
+    stories: list[Path],
+    workers: int = 1,
+    jsonl: bool = False,
+    parallel: int = 1,
+    out_dir: Path | None = None,
+    store: Path | None = None,
+) -> list[Outcome]:
+    """Download the threads `postids` and sync the story files `stories`.
+
+    Up to `parallel` of these jobs run at once, all sharing `CLIENT` and so its
+    limits on requests to the glowfic API.  A job that fails is reported and
+    does not stop the others.  The outcomes are in the order of the jobs.
+    """
+    progress = Progress()
+
+    def do_sync(path: Path) -> Path:
+        n = sync(path, workers, progress)
+        progress.log('%d new replies in "%s".' % (n, path))
+        return path
+
+    jobs: list[tuple[str, Callable[[], Path]]] = [
+        (
+            f"post {postid:d}",
+            partial(main, postid, workers, jsonl, progress, out_dir, store),
+        )
+        for postid in postids
+    ]
+    jobs += [(str(path), partial(do_sync, path)) for path in stories]
+
+    def run(job: tuple[str, Callable[[], Path]]) -> Outcome:
+        name, fn = job
+        start = time.monotonic()
+        try:
+            path = fn()
+        except Exception as e:
+            progress.log(f"{name}: failed: {e}")
+            return Outcome(name, None, str(e) or repr(e), time.monotonic() - start)
+        return Outcome(name, path, None, time.monotonic() - start)
+
+    with ThreadPoolExecutor(max_workers=max(parallel, 1)) as pool:
+        return list(pool.map(run, jobs))
 
 
 if __name__ == "__main__":
-    for arg in sys.argv[1:]:
-        main(int(arg))
+    parser = argparse.ArgumentParser(description="Download glowfic threads.")
+    parser.add_argument("postids", nargs="*", type=int, metavar="postid")
+    parser.add_argument(
+        "-j",
+        "--workers",
+        type=int,
+        default=1,
+        help="number of reply pages to fetch concurrently",
+    )
+    parser.add_argument(
+        "--jsonl",
+        action="store_true",
+        help="write stories as JSON Lines, one post per line",
+    )
+    parser.add_argument(
+        "-p",
+        "--parallel",
+        type=int,
+        default=1,
+        help="number of threads to download or sync at once",
+    )
+    parser.add_argument(
+        "--store",
+        type=Path,
+        metavar="DB",
+        help="write the threads into this SQLite story store, where they can be "
+        "read as DB#postid",
+    )
+    parser.add_argument(
+        "--sync",
+        nargs="+",
+        type=Path,
+        default=[],
+        metavar="STORY",
+        help="update existing story files with the replies they are missing; "
+        "a story store stands for all the threads in it",
+    )
+    add_client_arguments(parser)
+    add_metrics_argument(parser)
+    args = parser.parse_args()
+    start = time.monotonic()
+    stories: list[Path] = []
+    for path in args.sync:
+        if path.suffix in STORE_SUFFIXES:
+            with StoryStore(path) as store:
+                stories += [store_path(path, thread) for thread, _ in store.threads()]
+        else:
+            stories.append(path)
+    with recording(args.metrics), configured(args):
+        outcomes = batch(
+            args.postids,
+            stories,
+            args.workers,
+            args.jsonl,
+            args.parallel,
+            store=args.store,
+        )
+    if not summarize(outcomes, time.monotonic() - start):
+        sys.exit(1)
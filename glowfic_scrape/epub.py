@@ -0,0 +1,287 @@
+"""Writing stories as EPUB books, without Calibre.
+
+Posts are rendered with `to_html.render_posts` and streamed into the zip container
+as a series of XHTML chapters, so that a story is never held in memory as a whole.
+The package document, the EPUB 3 navigation document and an NCX table of contents
+(for older readers) are written after the chapters, and the icons the posts use
+are copied in from the `images` directory.
+"""
+from concurrent.futures import Executor
+import datetime
+from html import escape
+import os
+from pathlib import Path
+import time
+from typing import IO, Final, Iterable
+import uuid
+import zipfile
+
+import lxml.etree
+import lxml.html
+
+from .common_types import HtmlCode, PostInfo, StoryHeader
+from .icons import sniff
+from .render_cache import RenderCache
+from .to_html import Split, format_time, paginate
+
+__all__ = ["CHAPTER_SPLIT", "write_epub"]
+
+CHAPTER_SPLIT: Final = Split(bytes=1 << 18)
+"""Where chapters are split by default; some readers are slow on larger files."""
+
+_IMAGE_TYPES: Final = {
+    "jpg": "image/jpeg",
+    "png": "image/png",
+    "gif": "image/gif",
+    "webp": "image/webp",  # a core media type since EPUB 3.3
+}
+
+_CONTAINER: Final = """<?xml version="1.0" encoding="utf-8"?>
+<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">
+<rootfiles>
+<rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/>
+</rootfiles>
+</container>
+"""
+
+_STYLE: Final = """\
+pre{overflow-x:auto;}
+div p{text-indent:2em;margin-top:0;margin-bottom:0}
+div p:first-child{text-indent:0;}
+h1, h2{text-align:center;}
+div.box{font-style:italic;margin-bottom:0.2em;}
+a:link, a:hover, a:active, a:visited {color:inherit;}
+span.character-pic img{width:100px;max-height:200px;}
+span.character-name{font-weight:bold;}
+div.spoiler{border: 2px solid black;margin:4px 0;padding:4px;}
+p.spoiler-summary{font-weight:bold;margin-bottom:8px;text-align:center;}
+"""
+
+_XHTML_HEAD: Final = """<?xml version="1.0" encoding="utf-8"?>
+<!DOCTYPE html>
+<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops" \
+lang="en-US" xml:lang="en-US">
+<head>
+<meta charset="utf-8"/>
+<title>{title}</title>
+<link rel="stylesheet" type="text/css" href="style.css"/>
+</head>
+<body>
+"""
+_XHTML_FOOT: Final = "</body>\n</html>\n"
+
+_TITLE_PAGE: Final = (
+    _XHTML_HEAD
+    + """<h1>{title}</h1>
+<div>{authors}</div>
+<div><a href="{comments}">{comments}</a></div>
+"""
+    + _XHTML_FOOT
+)
+
+_NAV: Final = (
+    _XHTML_HEAD
+    + """<nav epub:type="toc" id="toc">
+<h1>Contents</h1>
+<ol>
+{items}</ol>
+</nav>
+"""
+    + _XHTML_FOOT
+)
+
+_NCX: Final = """<?xml version="1.0" encoding="utf-8"?>
+<ncx xmlns="http://www.daisy.org/z3986/2005/ncx/" version="2005-1">
+<head>
+<meta name="dtb:uid" content="{identifier}"/>
+</head>
+<docTitle><text>{title}</text></docTitle>
+<navMap>
+{points}</navMap>
+</ncx>
+"""
+
+_OPF: Final = """<?xml version="1.0" encoding="utf-8"?>
+<package xmlns="http://www.idpf.org/2007/opf" version="3.0" \
+unique-identifier="id" xml:lang="en-US">
+<metadata xmlns:dc="http://purl.org/dc/elements/1.1/">
+<dc:identifier id="id">{identifier}</dc:identifier>
+<dc:title>{title}</dc:title>
+{creators}<dc:language>en-US</dc:language>
+<dc:source>{comments}</dc:source>
+<meta property="dcterms:modified">{modified}</meta>
+</metadata>
+<manifest>
+<item id="nav" href="nav.xhtml" media-type="application/xhtml+xml" properties="nav"/>
+<item id="ncx" href="toc.ncx" media-type="application/x-dtbncx+xml"/>
+<item id="style" href="style.css" media-type="text/css"/>
+<item id="title" href="title.xhtml" media-type="application/xhtml+xml"/>
+{items}</manifest>
+<spine toc="ncx">
+<itemref idref="title"/>
+{itemrefs}</spine>
+</package>
+"""
+
+
+def write_epub(
+    header: StoryHeader,
+    posts: Iterable[PostInfo],
+    path: Path,
+    split: Split = CHAPTER_SPLIT,
+    pool: Executor | None = None,
+    cache: RenderCache | None = None,
+    images: Path = Path("images"),
+) -> None:
+    """Write a story as an EPUB book, atomically.
+
+    The posts are rendered as they are consumed (on `pool` and with `cache`, as
+    in `to_html.render_posts`) and split into chapters at `split`.  Icons that are
+    missing from `images` are left out.
+    """
+    tmp = path.with_name(path.name + ".tmp")
+    try:
+        with zipfile.ZipFile(tmp, "w", zipfile.ZIP_DEFLATED) as book:
+            _write_book(book, header, posts, split, pool, cache, images)
+        os.replace(tmp, path)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+
+
+def _write_book(
+    book: zipfile.ZipFile,
+    header: StoryHeader,
+    posts: Iterable[PostInfo],
+    split: Split,
+    pool: Executor | None,
+    cache: RenderCache | None,
+    images: Path,
+) -> None:
+    # the mimetype must come first, uncompressed
+    book.writestr("mimetype", "application/epub+zip", zipfile.ZIP_STORED)
+    book.writestr("META-INF/container.xml", _CONTAINER)
+    book.writestr("OEBPS/style.css", _STYLE)
+    title = escape(header["title"])
+    book.writestr(
+        "OEBPS/title.xhtml",
+        _TITLE_PAGE.format(
+            title=title,
+            authors=escape(header["authors"]),
+            comments=escape(header["comments"]),
+        ),
+    )
+
+    icons: dict[str, str | None] = {}  # file name: media type, None if unusable
+    chapters: list[tuple[str, str]] = []  # file name, heading
+    o: IO[bytes] | None = None
+    try:
+        for new_chapter, posted, html in paginate(posts, split, pool, cache):
+            if new_chapter:
+                if o is not None:
+                    o.write(_XHTML_FOOT.encode("utf8"))
+                    o.close()
+                name = f"chapter_{len(chapters) + 1:03d}.xhtml"
+                heading = f"Part {len(chapters) + 1:d} · {format_time(posted)}"
+                chapters.append((name, heading))
+                info = zipfile.ZipInfo(f"OEBPS/{name}", time.localtime()[:6])
+                info.compress_type = zipfile.ZIP_DEFLATED
+                o = book.open(info, "w")
+                head = _XHTML_HEAD.format(title=f"{title} – {heading}")
+                o.write(f"{head}<h2>{heading}</h2>\n<hr/>\n".encode("utf8"))
+            assert o is not None
+            o.write(_xhtml(html, images, icons).encode("utf8"))
+        if o is not None:
+            o.write(_XHTML_FOOT.encode("utf8"))
+    finally:
+        if o is not None:
+            o.close()
+
+    used = {name: media for name, media in icons.items() if media is not None}
+    for name in used:
+        # images are compressed already
+        book.write(images / name, f"OEBPS/images/{name}", zipfile.ZIP_STORED)
+
+    toc = [("title.xhtml", title)] + chapters
+    identifier = f"urn:uuid:{uuid.uuid5(uuid.NAMESPACE_URL, header['comments'])}"
+    book.writestr(
+        "OEBPS/nav.xhtml",
+        _NAV.format(
+            title=title,
+            items="".join(
+                f'<li><a href="{name}">{heading}</a></li>\n' for name, heading in toc
+            ),
+        ),
+    )
+    book.writestr(
+        "OEBPS/toc.ncx",
+        _NCX.format(
+            identifier=identifier,
+            title=title,
+            points="".join(
+                f'<navPoint id="p{i:d}" playOrder="{i:d}">'
+                f"<navLabel><text>{heading}</text></navLabel>"
+                f'<content src="{name}"/></navPoint>\n'
+                for i, (name, heading) in enumerate(toc, 1)
+            ),
+        ),
+    )
+    items = [
+        f'<item id="c{i:d}" href="{name}" media-type="application/xhtml+xml"/>\n'
+        for i, (name, _) in enumerate(chapters, 1)
+    ]
+    items += [
+        f'<item id="i{i:d}" href="images/{name}" media-type="{media}"/>\n'
+        for i, (name, media) in enumerate(used.items(), 1)
+    ]
+    book.writestr(
+        "OEBPS/content.opf",
+        _OPF.format(
+            identifier=identifier,
+            title=title,
+            creators="".join(
+                f"<dc:creator>{escape(author)}</dc:creator>\n"
+                for author in header["authors"].split(" & ")
+            ),
+            comments=escape(header["comments"]),
+            modified=datetime.datetime.now(datetime.timezone.utc).strftime(
+                "%Y-%m-%dT%H:%M:%SZ"
+            ),
+            items="".join(items),
+            itemrefs="".join(
+                f'<itemref idref="c{i:d}"/>\n' for i in range(1, len(chapters) + 1)
+            ),
+        ),
+    )
+
+
+def _xhtml(html: HtmlCode, images: Path, icons: dict[str, str | None]) -> str:
+    """Turn a rendered post into XHTML, dropping icons that can't be included.
+
+    `icons` caches the media type of each icon file seen so far.
+    """
+    out = []
+    for el in lxml.html.fragments_fromstring(html):
+        if isinstance(el, str):
+            out.append(escape(el, quote=False))
+            continue
+        for img in list(el.iter("img")):
+            src = img.get("src", "")
+            if src.startswith("images/"):
+                name = src.removeprefix("images/")
+                if name not in icons:
+                    icons[name] = _media_type(images / name)
+                if icons[name] is None:
+                    img.drop_tree()
+        out.append(lxml.etree.tostring(el, method="xml", encoding=str))
+    return "".join(out)
+
+
+def _media_type(path: Path) -> str | None:
+    """The media type of an image file, from its first bytes; None if not usable."""
+    try:
+        with path.open("rb") as f:
+            start = f.read(12)
+    except OSError:
+        return None
+    return _IMAGE_TYPES.get(sniff(start) or "")
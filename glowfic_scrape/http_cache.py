@@ -0,0 +1,122 @@
+"""On-disk cache of HTTP responses, revalidated with conditional requests.
+
+Responses that carry an ``ETag`` or ``Last-Modified`` header are stored with their
+body.  When the same URL is fetched again, the client sends ``If-None-Match`` and
+``If-Modified-Since``, and if the server answers ``304 Not Modified``, the body
+comes from the cache instead of the network.  The cache lives in a SQLite file
+and is kept below a size limit by evicting the least recently used entries.
+"""
+import http.client
+import io
+from pathlib import Path
+import sqlite3
+import threading
+from typing import TYPE_CHECKING, Final, NamedTuple
+
+from .lru import LRU
+
+if TYPE_CHECKING:
+    from .http_client import Response
+
+__all__ = ["HTTPCache", "CachedResponse", "DEFAULT_MAX_BYTES"]
+
+DEFAULT_MAX_BYTES: Final = 1 << 30
+
+_SCHEMA: Final = """
+PRAGMA journal_mode = WAL;
+CREATE TABLE IF NOT EXISTS responses (
+    url TEXT PRIMARY KEY,
+    final_url TEXT NOT NULL,
+    etag TEXT,
+    last_modified TEXT,
+    headers TEXT NOT NULL,
+    body BLOB NOT NULL,
+    size INTEGER NOT NULL,
+    used INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS responses_used ON responses (used);
+"""
+
+
+class CachedResponse(NamedTuple):
+    final_url: str
+    etag: str | None
+    last_modified: str | None
+    headers: str
+    body: bytes
+
+    def validators(self) -> dict[str, str]:
+        """Headers that make a request conditional on the entry being stale."""
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+    def parsed_headers(self) -> http.client.HTTPMessage:
+        return http.client.parse_headers(io.BytesIO(self.headers.encode("latin-1")))
+
+
+class HTTPCache:
+    """A size-bounded cache of HTTP responses in a SQLite file.
+
+    Evicts least recently used entries when closed.  Thread-safe.
+    """
+
+    def __init__(self, path: Path, max_bytes: int = DEFAULT_MAX_BYTES) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self._db.executescript(_SCHEMA)
+        self._lru = LRU(self._db, "responses", "url")
+
+    def lookup(self, url: str) -> CachedResponse | None:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT final_url, etag, last_modified, headers, body"
+                " FROM responses WHERE url = ?",
+                (url,),
+            ).fetchone()
+            if row is None:
+                return None
+            self._lru.use([url])
+        return CachedResponse(*row)
+
+    def store(self, url: str, response: "Response") -> None:
+        """Keep `response` if it can be revalidated later."""
+        etag = response.headers.get("ETag")
+        last_modified = response.headers.get("Last-Modified")
+        if response.status != 200 or not (etag or last_modified):
+            return
+        headers = "".join(
+            f"{name}: {value}\r\n"
+            for name, value in response.headers.items()
+            if name.lower() not in ("content-encoding", "content-length")
+        )
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    url,
+                    response.url,
+                    etag,
+                    last_modified,
+                    headers,
+                    response.body,
+                    len(response.body),
+                    self._lru.now,
+                ),
+            )
+
+    def close(self) -> None:
+        with self._lock, self._db:
+            self._lru.close(self.max_bytes)
+        self._db.close()
+
+    def __enter__(self) -> "HTTPCache":
+        return self
+
+    def __exit__(self, *exc: object) -> None:
+        self.close()
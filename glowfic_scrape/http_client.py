@@ -0,0 +1,476 @@
+"""A small keep-alive HTTP client shared by the downloaders.
+
+Connections are pooled per host, so that fetching many pages or images from the
+same server only pays for the TCP/TLS handshake once per connection.  The number
+of requests in flight and the rate at which they are sent can be capped per host.
+
+Requests that fail in a way that may go away (throttling, server errors, timeouts,
+dropped connections) are retried with exponential backoff.  A host that throttles
+us, or slows down, gets fewer concurrent requests for a while, and a host that
+sends ``Retry-After`` gets no requests at all until then.
+
+With an `HTTPCache`, responses are revalidated with conditional requests instead
+of being downloaded again.
+
+The commands that download take the same options for the shared `CLIENT`
+(`add_client_arguments`), and apply them with `configured`.
+"""
+import argparse
+from contextlib import contextmanager
+import datetime
+import email.utils
+import http.client
+import json
+import math
+from pathlib import Path
+import random
+import ssl
+import threading
+import time
+from typing import Any, Final, Iterator, NamedTuple
+from urllib.parse import quote, urljoin, urlsplit
+import zlib
+
+from .http_cache import HTTPCache
+from .metrics import METRICS
+
+__all__ = [
+    "Client",
+    "HTTPError",
+    "Response",
+    "TokenBucket",
+    "CLIENT",
+    "add_client_arguments",
+    "configured",
+]
+
+DEFAULT_TIMEOUT: Final = 30.0
+MAX_PER_HOST: Final = 8
+MAX_REDIRECTS: Final = 5
+MAX_RETRIES: Final = 5
+BACKOFF_BASE: Final = 0.5
+"""Seconds; the n-th retry waits a random time of up to ``BACKOFF_BASE * 2**n``."""
+BACKOFF_CAP: Final = 60.0
+MAX_RETRY_AFTER: Final = 300.0
+"""Longest ``Retry-After`` worth waiting for; beyond that the request fails."""
+SLOW_FACTOR: Final = 4.0
+"""Response times this many times the baseline count as congestion."""
+BASELINE_DRIFT: Final = 0.05
+"""How far the baseline response time moves towards each slower response.
+
+The baseline follows faster responses at once and slower ones slowly, so that
+one quick response (a ``304``, a short page) does not make the usual response
+time look like congestion for the rest of the run."""
+USER_AGENT: Final = "glowfic-scrape"
+
+_REDIRECTS: Final = frozenset({301, 302, 303, 307, 308})
+_RETRY_STATUSES: Final = frozenset({429, 500, 502, 503, 504})
+_THROTTLE_STATUSES: Final = frozenset({429, 503})
+
+_HostKey = tuple[str, str, int]
+
+
+class HTTPError(OSError):
+    """The server answered with an error status."""
+
+    def __init__(
+        self, url: str, status: int, reason: str, retry_after: float | None = None
+    ) -> None:
+        super().__init__(f"HTTP {status} {reason}: {url}")
+        self.url = url
+        self.status = status
+        self.retry_after = retry_after
+
+
+class Response(NamedTuple):
+    url: str
+    status: int
+    headers: http.client.HTTPMessage
+    body: bytes
+
+    def json(self) -> Any:
+        return json.loads(self.body)
+
+
+class TokenBucket:
+    """Lets through `rate` acquisitions per second on average.
+
+    Up to `burst` acquisitions can happen at once after a quiet period.  Waiting
+    callers are served in the order they arrived.  Thread-safe.
+    """
+
+    def __init__(self, rate: float, burst: float = 1.0) -> None:
+        self.rate = rate
+        self.burst = max(burst, 1.0)
+        self._tokens = self.burst
+        self._stamp = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        """Take a token, sleeping until one is available."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self.burst, self._tokens + (now - self._stamp) * self.rate
+            )
+            self._stamp = now
+            # going into debt reserves the next token for this caller
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+        if wait:
+            time.sleep(wait)
+
+
+class _Host:
+    """What the client knows about one server.
+
+    `limit` is the number of requests allowed in flight.  It grows by one per
+    `limit` successful requests, up to `max_requests`, and is halved (at most once
+    per response time) when the server throttles us, times out or slows down.
+    """
+
+    def __init__(self, max_requests: int, rate: float | None) -> None:
+        self.max_requests = max_requests
+        self.limit = float(max_requests)
+        self.bucket = TokenBucket(rate) if rate else None
+        self.idle: list[http.client.HTTPConnection] = []
+        self.in_flight = 0
+        self.resume_at = 0.0
+        self.latency = 0.0
+        self.baseline = math.inf
+        self.last_decrease = 0.0
+        self.ready = threading.Condition()
+
+    def enter(self) -> None:
+        """Wait until a request to the host may be sent."""
+        with self.ready:
+            while self.in_flight >= int(self.limit):
+                self.ready.wait()
+            self.in_flight += 1
+        pause = self.resume_at - time.monotonic()
+        if pause > 0:
+            time.sleep(pause)
+        if self.bucket is not None:
+            self.bucket.acquire()
+
+    def leave(self) -> None:
+        with self.ready:
+            self.in_flight -= 1
+            self.ready.notify_all()
+
+    def succeeded(self, latency: float) -> None:
+        with self.ready:
+            if self.latency:
+                self.latency = 0.8 * self.latency + 0.2 * latency
+            else:
+                self.latency = latency
+            if latency < self.baseline:
+                self.baseline = latency
+            else:
+                self.baseline += BASELINE_DRIFT * (latency - self.baseline)
+            if self.latency > SLOW_FACTOR * self.baseline:
+                self._decrease()
+            else:
+                self.limit = min(self.limit + 1 / self.limit, self.max_requests)
+
+    def throttled(self, retry_after: float | None = None) -> None:
+        with self.ready:
+            self._decrease()
+            if retry_after:
+                self.resume_at = max(self.resume_at, time.monotonic() + retry_after)
+
+    def _decrease(self) -> None:
+        now = time.monotonic()
+        # one congestion event usually hits all requests in flight at once
+        if now - self.last_decrease > self.latency:
+            self.limit = max(self.limit / 2, 1.0)
+            self.last_decrease = now
+
+
+class Client:
+    """HTTP client with per-host pools of persistent connections.
+
+    At most `max_per_host` requests to the same host are in flight at any time;
+    further requests wait for a free connection.  The client lowers that number
+    for hosts that throttle or slow down, and raises it again as they recover.
+    With `rate` set, requests to each host are also spaced out to at most `rate`
+    per second.  Both limits take effect for hosts that have not been contacted
+    yet, so set them before the first request.
+
+    Throttled, failed and timed out requests are retried up to `retries` times.
+    Response bodies compressed with gzip or deflate are decoded transparently.
+    With `cache`, responses that can be revalidated are kept there, and a ``304
+    Not Modified`` answer is served from it.  The client is thread-safe.
+    """
+
+    def __init__(
+        self,
+        timeout: float = DEFAULT_TIMEOUT,
+        max_per_host: int = MAX_PER_HOST,
+        rate: float | None = None,
+        retries: int = MAX_RETRIES,
+        cache: HTTPCache | None = None,
+    ) -> None:
+        self.timeout = timeout
+        self.max_per_host = max_per_host
+        self.rate = rate
+        self.retries = retries
+        self.cache = cache
+        self._lock = threading.Lock()
+        self._hosts: dict[_HostKey, _Host] = {}
+        self._ssl_context = ssl.create_default_context()
+
+    def get(
+        self,
+        url: str,
+        headers: dict[str, str] | None = None,
+        timeout: float | None = None,
+    ) -> Response:
+        """GET `url`, following redirects; raises `HTTPError` on error statuses.
+
+        Throttling, server errors, timeouts and connection errors are retried.
+        """
+        attempt = 0
+        while True:
+            try:
+                return self._get(url, headers or {}, timeout)
+            except (HTTPError, ConnectionError, TimeoutError) as e:
+                if attempt >= self.retries or not _retryable(e):
+                    raise
+            METRICS.count("http.retries")
+            # full jitter; a Retry-After is waited for in `_Host.enter`
+            time.sleep(random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2**attempt)))
+            attempt += 1
+
+    def get_json(self, url: str, timeout: float | None = None) -> Any:
+        return self.get(url, {"Accept": "application/json"}, timeout).json()
+
+    @contextmanager
+    def caching(self, path: Path | None) -> Iterator[None]:
+        """Keep responses in an `HTTPCache` in the file `path` within the block.
+
+        Does nothing if `path` is None.
+        """
+        if path is None:
+            yield
+            return
+        with HTTPCache(path) as cache:
+            self.cache = cache
+            try:
+                yield
+            finally:
+                self.cache = None
+
+    def close(self) -> None:
+        """Close all idle connections."""
+        with self._lock:
+            idle = [conn for host in self._hosts.values() for conn in host.idle]
+            for host in self._hosts.values():
+                host.idle.clear()
+        for conn in idle:
+            conn.close()
+
+    def _get(
+        self, url: str, headers: dict[str, str], timeout: float | None
+    ) -> Response:
+        cache = self.cache
+        cached = cache.lookup(url) if cache is not None else None
+        if cached is not None:
+            headers = {**headers, **cached.validators()}
+        requested = url
+        for _ in range(MAX_REDIRECTS + 1):
+            resp, body = self._request(url, headers, timeout)
+            location = resp.getheader("Location")
+            if resp.status in _REDIRECTS and location:
+                url = urljoin(url, location)
+                continue
+            if resp.status == 304 and cached is not None:
+                METRICS.count("http.not_modified")
+                return Response(
+                    cached.final_url, 200, cached.parsed_headers(), cached.body
+                )
+            if resp.status >= 400:
+                retry_after = _retry_after(resp.getheader("Retry-After"))
+                raise HTTPError(url, resp.status, resp.reason, retry_after)
+            response = Response(url, resp.status, resp.headers, _decode(resp, body))
+            if cache is not None:
+                cache.store(requested, response)
+            return response
+        raise HTTPError(url, resp.status, "too many redirects")
+
+    def _request(
+        self, url: str, headers: dict[str, str], timeout: float | None
+    ) -> tuple[http.client.HTTPResponse, bytes]:
+        parts = urlsplit(url)
+        scheme = parts.scheme.lower()
+        if scheme not in ("http", "https") or not parts.hostname:
+            raise ValueError(f"unsupported URL: {url!r}")
+        port = parts.port or (443 if scheme == "https" else 80)
+        key: _HostKey = (scheme, parts.hostname, port)
+        target = quote(
+            (parts.path or "/") + (f"?{parts.query}" if parts.query else ""),
+            safe="!$%&'()*+,/:;=?@[]~",
+        )
+        headers = {
+            "User-Agent": USER_AGENT,
+            "Accept-Encoding": "gzip, deflate",
+            **headers,
+        }
+        host = self._host(key)
+        host.enter()
+        try:
+            conn = self._checkout(key, host)
+            reused = conn.sock is not None
+            conn.timeout = self.timeout if timeout is None else timeout
+            if reused:
+                conn.sock.settimeout(conn.timeout)
+            try:
+                try:
+                    resp, body, latency = _roundtrip(conn, target, headers)
+                except (ConnectionError, http.client.BadStatusLine):
+                    if not reused:
+                        raise
+                    # the server closed an idle connection; retry on a fresh one
+                    conn.close()
+                    resp, body, latency = _roundtrip(conn, target, headers)
+            except http.client.HTTPException as e:
+                METRICS.count("http.errors")
+                conn.close()
+                host.throttled()
+                raise ConnectionError(f"{e!r} while fetching {url}") from e
+            except (ConnectionError, TimeoutError):
+                METRICS.count("http.errors")
+                conn.close()
+                host.throttled()
+                raise
+            except BaseException:
+                conn.close()
+                raise
+            METRICS.count("http.requests")
+            METRICS.count(f"http.status.{resp.status:d}")
+            METRICS.count("http.bytes", len(body))
+            METRICS.observe("http.latency", latency)
+            if resp.status in _THROTTLE_STATUSES:
+                host.throttled(_retry_after(resp.getheader("Retry-After")))
+            elif resp.status < 500:
+                host.succeeded(latency)
+            if resp.will_close:
+                conn.close()
+            else:
+                with self._lock:
+                    host.idle.append(conn)
+        finally:
+            host.leave()
+        return resp, body
+
+    def _host(self, key: _HostKey) -> _Host:
+        with self._lock:
+            host = self._hosts.get(key)
+            if host is None:
+                host = self._hosts[key] = _Host(self.max_per_host, self.rate)
+            return host
+
+    def _checkout(self, key: _HostKey, host: _Host) -> http.client.HTTPConnection:
+        with self._lock:
+            if host.idle:
+                return host.idle.pop()
+        scheme, hostname, port = key
+        if scheme == "https":
+            return http.client.HTTPSConnection(
+                hostname, port, timeout=self.timeout, context=self._ssl_context
+            )
+        return http.client.HTTPConnection(hostname, port, timeout=self.timeout)
+
+
+def _roundtrip(
+    conn: http.client.HTTPConnection, target: str, headers: dict[str, str]
+) -> tuple[http.client.HTTPResponse, bytes, float]:
+    """Send a request; returns the response, its body and the time to its headers."""
+    start = time.monotonic()
+    conn.request("GET", target, headers=headers)
+    resp = conn.getresponse()
+    latency = time.monotonic() - start
+    return resp, resp.read(), latency
+
+
+def _retryable(e: OSError) -> bool:
+    if isinstance(e, HTTPError):
+        if e.retry_after is not None and e.retry_after > MAX_RETRY_AFTER:
+            return False
+        return e.status in _RETRY_STATUSES
+    return True
+
+
+def _retry_after(value: str | None) -> float | None:
+    """Seconds to wait according to a ``Retry-After`` header."""
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=datetime.timezone.utc)
+    now = datetime.datetime.now(datetime.timezone.utc)
+    return max((when - now).total_seconds(), 0.0)
+
+
+def _decode(resp: http.client.HTTPResponse, body: bytes) -> bytes:
+    encoding = (resp.getheader("Content-Encoding") or "").strip().lower()
+    if encoding in ("gzip", "x-gzip"):
+        return zlib.decompress(body, 16 + zlib.MAX_WBITS)
+    if encoding == "deflate":
+        try:
+            return zlib.decompress(body)
+        except zlib.error:
+            # some servers send raw deflate data without the zlib wrapper
+            return zlib.decompress(body, -zlib.MAX_WBITS)
+    return body
+
+
+CLIENT: Final = Client()
+"""The client shared by `download_thread` and `download_images`."""
+
+
+def add_client_arguments(
+    parser: argparse.ArgumentParser, limits: bool = True
+) -> None:
+    """Add the options that `configured` applies to `CLIENT` to `parser`.
+
+    They are ``--http-cache FILE`` and, with `limits`, ``--max-requests N`` and
+    ``--rate N``.
+    """
+    if limits:
+        parser.add_argument(
+            "--max-requests",
+            type=int,
+            default=MAX_PER_HOST,
+            help="most requests to the glowfic API in flight at once "
+            "(default: %(default)s)",
+        )
+        parser.add_argument(
+            "--rate",
+            type=float,
+            help="most requests per second to the glowfic API (default: no limit)",
+        )
+    parser.add_argument(
+        "--http-cache",
+        type=Path,
+        metavar="FILE",
+        help="revalidate responses kept in this cache file instead of "
+        "downloading them again",
+    )
+
+
+@contextmanager
+def configured(args: argparse.Namespace) -> Iterator[None]:
+    """Apply the options of `add_client_arguments` to `CLIENT` within the block."""
+    if hasattr(args, "max_requests"):
+        CLIENT.max_per_host = args.max_requests
+        CLIENT.rate = args.rate
+    with CLIENT.caching(args.http_cache):
+        yield
@@ -0,0 +1,121 @@
+"""A content-addressed store of icons, shared by all stories.
+
+Each icon is kept once, under the SHA-256 of its contents, however many URLs it
+is served from; an index maps URLs to contents.  Stories get icons from the
+store as hard links in their own `images` directories (or copies, where hard
+links are not possible), so an icon takes disk space once and is downloaded
+once for all stories.  The store is kept below a size limit by evicting the
+least recently used icons; icons linked into stories stay there.
+"""
+import hashlib
+import os
+from pathlib import Path
+import shutil
+import sqlite3
+import threading
+from typing import Final
+
+from .lru import LRU
+
+__all__ = ["IconStore", "DEFAULT_MAX_BYTES", "default_path", "link"]
+
+DEFAULT_MAX_BYTES: Final = 2 << 30
+INDEX: Final = "index.sqlite"
+
+_SCHEMA: Final = """
+PRAGMA journal_mode = WAL;
+CREATE TABLE IF NOT EXISTS blobs (
+    digest TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    used INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS blobs_used ON blobs (used);
+CREATE TABLE IF NOT EXISTS urls (
+    url TEXT PRIMARY KEY,
+    digest TEXT NOT NULL REFERENCES blobs (digest) ON DELETE CASCADE
+);
+CREATE INDEX IF NOT EXISTS urls_digest ON urls (digest);
+"""
+
+
+def default_path() -> Path:
+    """``$XDG_CACHE_HOME/glowfic_scrape/icons``, or under ``~/.cache``."""
+    cache = os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache"
+    return Path(cache) / "glowfic_scrape" / "icons"
+
+
+class IconStore:
+    """A size-bounded store of icons in a directory.
+
+    Evicts least recently used icons when closed.  Thread-safe; several
+    processes may use the same store.
+    """
+
+    def __init__(self, path: Path, max_bytes: int = DEFAULT_MAX_BYTES) -> None:
+        path.mkdir(parents=True, exist_ok=True)
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path / INDEX, timeout=60, check_same_thread=False)
+        self._db.executescript(_SCHEMA)
+        self._db.execute("PRAGMA foreign_keys = ON")
+        self._lru = LRU(self._db, "blobs", "digest")
+
+    def lookup(self, url: str) -> Path | None:
+        """The stored icon served from `url`, if there is one."""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT digest FROM urls WHERE url = ?", (url,)
+            ).fetchone()
+            if row is None:
+                return None
+            blob = self._blob(row[0])
+            if not blob.exists():
+                return None
+            self._lru.use([row[0]])
+        return blob
+
+    def add(self, url: str, data: bytes) -> Path:
+        """Keep the icon `data`, served from `url`, and return its file."""
+        digest = hashlib.sha256(data).hexdigest()
+        blob = self._blob(digest)
+        if not blob.exists():
+            blob.parent.mkdir(exist_ok=True)
+            writer = f"{os.getpid()}-{threading.get_ident()}"
+            tmp = blob.with_name(f"{blob.name}.{writer}.tmp")
+            tmp.write_bytes(data)
+            os.replace(tmp, blob)
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT INTO blobs VALUES (?, ?, ?)"
+                " ON CONFLICT (digest) DO UPDATE SET used = excluded.used",
+                (digest, len(data), self._lru.now),
+            )
+            self._db.execute("INSERT OR REPLACE INTO urls VALUES (?, ?)", (url, digest))
+        return blob
+
+    def close(self) -> None:
+        with self._lock, self._db:
+            evicted = self._lru.close(self.max_bytes)
+        self._db.close()
+        for digest in evicted:
+            self._blob(digest).unlink(missing_ok=True)
+
+    def __enter__(self) -> "IconStore":
+        return self
+
+    def __exit__(self, *exc: object) -> None:
+        self.close()
+
+    def _blob(self, digest: str) -> Path:
+        return self.path / digest[:2] / digest[2:]
+
+
+def link(blob: Path, target: Path) -> None:
+    """Make `target` the same file as `blob`, or a copy if it can't be."""
+    try:
+        os.link(blob, target)
+    except FileExistsError:
+        pass
+    except OSError:
+        shutil.copyfile(blob, target)
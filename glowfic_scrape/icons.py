@@ -0,0 +1,160 @@
+"""Icons in the format and size in which they are shown.
+
+Icons are downloaded as they are served, and named ``<hash of the URL>.jpg``
+whatever their format.  `normalize` finds their real format and, if Pillow is
+installed, shrinks them to the size at which they are shown and recompresses
+them: opaque icons as JPEG, others as PNG.  Which file to show for each
+downloaded icon is kept in the manifest ``images/manifest.json``, which
+`to_html.picture` looks up.  Without Pillow, icons only get the suffix of their
+real format.
+"""
+from concurrent.futures import ProcessPoolExecutor
+import io
+from itertools import repeat
+import json
+import os
+from pathlib import Path
+from typing import Final, Iterable, TypedDict
+
+from .icon_store import link
+from .story_file import write_json
+
+try:
+    from PIL import Image
+except ImportError:  # optional; without it, icons keep their size
+    Image = None  # type: ignore[assignment]
+
+__all__ = ["ICON_SIZE", "QUALITY", "MANIFEST", "sniff", "icon_names", "normalize"]
+
+ICON_SIZE: Final = 200
+"""Largest width and height of shrunk icons, in pixels: twice the 100px at which
+they are shown, for high-density screens."""
+QUALITY: Final = 85
+"""JPEG quality of recompressed icons."""
+MANIFEST: Final = "manifest.json"
+
+_SIGNATURES: Final = {
+    b"\xff\xd8\xff": "jpg",
+    b"\x89PNG\r\n\x1a\n": "png",
+    b"GIF87a": "gif",
+    b"GIF89a": "gif",
+}
+
+
+class IconManifest(TypedDict):
+    size: int
+    quality: int
+    icons: dict[str, str]
+    """File name of each downloaded icon: file name of the icon to show."""
+
+
+def sniff(data: bytes) -> str | None:
+    """The usual suffix (without dot) of an image's format; None if unknown."""
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "webp"
+    for signature, suffix in _SIGNATURES.items():
+        if data.startswith(signature):
+            return suffix
+    return None
+
+
+def icon_names(dir: Path) -> dict[str, str]:
+    """The file to show for each downloaded icon in `dir` that was normalized."""
+    manifest = _read_manifest(dir)
+    return manifest["icons"] if manifest is not None else {}
+
+
+def normalize(
+    dir: Path,
+    names: Iterable[str],
+    size: int = ICON_SIZE,
+    quality: int = QUALITY,
+    processes: int | None = None,
+) -> dict[str, str]:
+    """Normalize the downloaded icons `names` in `dir`, and update the manifest.
+
+    Icons are shrunk to at most `size` pixels wide and high (0 to keep them as
+    they are), in up to `processes` processes.  Icons normalized before with the
+    same settings are skipped.  Returns the manifest's mapping of icon files.
+    """
+    manifest = _read_manifest(dir)
+    icons: dict[str, str] = {}
+    if manifest is not None:
+        if manifest["size"] == size and manifest["quality"] == quality:
+            icons = manifest["icons"]
+    todo = [
+        name
+        for name in dict.fromkeys(names)
+        if (name not in icons or not (dir / icons[name]).exists())
+        and (dir / name).exists()
+    ]
+    if todo:
+        paths = [dir / name for name in todo]
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            results = pool.map(
+                normalize_icon, paths, repeat(size), repeat(quality), chunksize=16
+            )
+            for name, shown in zip(todo, results):
+                if shown is not None:
+                    icons[name] = shown
+    write_json(IconManifest(size=size, quality=quality, icons=icons), dir / MANIFEST)
+    return icons
+
+
+def normalize_icon(path: Path, size: int, quality: int) -> str | None:
+    """Write the normalized version of an icon next to it and return its name.
+
+    Returns None if the file is not an image in a known format.
+    """
+    data = path.read_bytes()
+    suffix = sniff(data)
+    if suffix is None:
+        return None
+    if Image is None or size <= 0:
+        return _link(path, f"{path.stem}.{suffix}")
+    try:
+        shrunk = _shrink(data, suffix, size, quality)
+    except (OSError, ValueError, Image.DecompressionBombError):
+        shrunk = None  # Pillow can't read it, but a browser may
+    if shrunk is None:
+        return _link(path, f"{path.stem}.{suffix}")
+    data, suffix = shrunk
+    name = f"{path.stem}-{size:d}.{suffix}"
+    tmp = path.with_name(name + ".tmp")
+    tmp.write_bytes(data)
+    os.replace(tmp, path.with_name(name))
+    return name
+
+
+def _shrink(
+    data: bytes, suffix: str, size: int, quality: int
+) -> tuple[bytes, str] | None:
+    """Shrink and recompress an image; None if it is better left as it is."""
+    with Image.open(io.BytesIO(data)) as im:
+        small = im.width <= size and im.height <= size
+        if getattr(im, "n_frames", 1) > 1 or (small and suffix in ("jpg", "png")):
+            # keep animations moving, and small icons as they are
+            return None
+        im.thumbnail((size, size), Image.Resampling.LANCZOS)
+        out = io.BytesIO()
+        if im.mode in ("RGBA", "LA", "PA") or "transparency" in im.info:
+            im.convert("RGBA").save(out, "PNG", optimize=True)
+            return out.getvalue(), "png"
+        im.convert("RGB").save(out, "JPEG", quality=quality, optimize=True)
+        return out.getvalue(), "jpg"
+
+
+def _link(path: Path, name: str) -> str:
+    """Make `name` next to `path` the same file as `path`."""
+    target = path.with_name(name)
+    if target != path:
+        link(path, target)
+    return name
+
+
+def _read_manifest(dir: Path) -> IconManifest | None:
+    try:
+        manifest: IconManifest = json.loads((dir / MANIFEST).read_text())
+    except FileNotFoundError:
+        return None
+    return manifest
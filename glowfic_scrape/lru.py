@@ -0,0 +1,60 @@
+"""Least-recently-used eviction for the caches kept in SQLite files.
+
+Each entry of a cache table has its `size` and the time it was last `used`: the
+Unix time at which the cache was opened.  Using an entry is only noted in
+memory; when the cache is closed, the entries used get that time, and the least
+recently used entries are deleted until the rest fit in the size limit.
+"""
+import sqlite3
+import time
+from typing import Iterable
+
+__all__ = ["LRU"]
+
+
+class LRU:
+    """The use and eviction of the entries of `table`, keyed by its `key` column.
+
+    Not thread-safe; callers that share one between threads hold their lock.
+    """
+
+    def __init__(self, db: sqlite3.Connection, table: str, key: str) -> None:
+        self.db = db
+        self.table = table
+        self.key = key
+        self.now = int(time.time())
+        """The time to store as `used` with new entries."""
+        self._used: set[str] = set()
+
+    def use(self, keys: Iterable[str]) -> None:
+        self._used.update(keys)
+
+    def close(self, max_bytes: int) -> list[str]:
+        """Note when the entries used were used, and evict beyond `max_bytes`.
+
+        Call it in a transaction.  Returns the keys of the evicted entries.
+        """
+        self.db.executemany(
+            f"UPDATE {self.table} SET used = ? WHERE {self.key} = ?",
+            ((self.now, key) for key in self._used),
+        )
+        self._used.clear()
+        (total,) = self.db.execute(
+            f"SELECT COALESCE(SUM(size), 0) FROM {self.table}"
+        ).fetchone()
+        if total <= max_bytes:
+            return []
+        excess = total - max_bytes
+        doomed: list[str] = []
+        for key, size in self.db.execute(
+            f"SELECT {self.key}, size FROM {self.table} ORDER BY used"
+        ):
+            if excess <= 0:
+                break
+            doomed.append(key)
+            excess -= size
+        self.db.executemany(
+            f"DELETE FROM {self.table} WHERE {self.key} = ?",
+            ((key,) for key in doomed),
+        )
+        return doomed
@@ -0,0 +1,200 @@
+"""Counts and timings of what a run did, reported as JSON.
+
+The modules record into the shared `METRICS`: counters (requests, bytes, posts
+and so on) and timings, which keep a histogram with a bucket per power of two
+seconds.  Recording is off, and costs next to nothing, until `enabled` is set;
+the commands take ``--metrics FILE`` (`add_metrics_argument`) and run in
+`recording`, which sets it and writes a report there at the end of the run.
+Worker processes record into their own `METRICS`, whose contents they hand back
+with `take` to be `merge`d into the parent's.
+"""
+import argparse
+from contextlib import contextmanager
+import datetime
+import math
+from pathlib import Path
+import threading
+import time
+from types import TracebackType
+from typing import Any, Final, Iterator, NamedTuple
+
+from .story_file import write_json
+
+__all__ = [
+    "Metrics",
+    "Histogram",
+    "Snapshot",
+    "METRICS",
+    "add_metrics_argument",
+    "recording",
+]
+
+_MIN_EXPONENT: Final = -20
+"""The lowest bucket holds everything up to 2**-20 s, about a microsecond."""
+
+
+class Histogram:
+    """Count, total, maximum and distribution of observed durations."""
+
+    __slots__ = ("count", "total", "max", "buckets")
+
+    def __init__(self) -> None:
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets: dict[int, int] = {}  # exponent e: count of values <= 2**e
+
+    def add(self, seconds: float) -> None:
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        e = _MIN_EXPONENT
+        if seconds > 2.0**_MIN_EXPONENT:
+            e = math.ceil(math.log2(seconds))
+        self.buckets[e] = self.buckets.get(e, 0) + 1
+
+    def merge(self, other: "Histogram") -> None:
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+        for e, n in other.buckets.items():
+            self.buckets[e] = self.buckets.get(e, 0) + n
+
+    def quantile(self, q: float) -> float:
+        """Upper bound of the bucket that holds the `q` quantile."""
+        rank = q * self.count
+        seen = 0
+        for e in sorted(self.buckets):
+            seen += self.buckets[e]
+            if seen >= rank:
+                return min(2.0**e, self.max)
+        return self.max
+
+    def as_dict(self) -> dict[str, Any]:
+        return {
+            "count": self.count,
+            "total": self.total,
+            "mean": self.total / self.count if self.count else 0.0,
+            "max": self.max,
+            "p50": self.quantile(0.5),
+            "p90": self.quantile(0.9),
+            "p99": self.quantile(0.99),
+            "buckets": [[2.0**e, self.buckets[e]] for e in sorted(self.buckets)],
+        }
+
+
+class Snapshot(NamedTuple):
+    counters: dict[str, float]
+    timings: dict[str, Histogram]
+
+
+class Metrics:
+    """Counters and timings, recorded only while `enabled`.  Thread-safe."""
+
+    def __init__(self) -> None:
+        self.enabled = False
+        self._lock = threading.Lock()
+        self._counters: dict[str, float] = {}
+        self._timings: dict[str, Histogram] = {}
+        self._started = datetime.datetime.now(datetime.timezone.utc)
+
+    def count(self, name: str, n: float = 1) -> None:
+        if self.enabled:
+            with self._lock:
+                self._counters[name] = self._counters.get(name, 0) + n
+
+    def observe(self, name: str, seconds: float) -> None:
+        if self.enabled:
+            with self._lock:
+                timing = self._timings.get(name)
+                if timing is None:
+                    timing = self._timings[name] = Histogram()
+                timing.add(seconds)
+
+    def timer(self, name: str) -> "_Timer":
+        """A context manager that observes how long its block takes."""
+        return _Timer(self, name)
+
+    def take(self) -> Snapshot:
+        """Return what was recorded so far, and start over."""
+        with self._lock:
+            snapshot = Snapshot(self._counters, self._timings)
+            self._counters = {}
+            self._timings = {}
+        return snapshot
+
+    def merge(self, snapshot: Snapshot) -> None:
+        """Add what another `Metrics` recorded, such as a worker process's."""
+        with self._lock:
+            for name, n in snapshot.counters.items():
+                self._counters[name] = self._counters.get(name, 0) + n
+            for name, timing in snapshot.timings.items():
+                self._timings.setdefault(name, Histogram()).merge(timing)
+
+    def report(self, seconds: float) -> dict[str, Any]:
+        """Everything recorded, with rates over a run of `seconds`."""
+        with self._lock:
+            counters = dict(sorted(self._counters.items()))
+            timings = dict(sorted(self._timings.items()))
+        return {
+            "started": self._started.isoformat(),
+            "seconds": seconds,
+            "counters": counters,
+            "per_second": {
+                name: n / seconds if seconds > 0 else 0.0
+                for name, n in counters.items()
+            },
+            "timings": {name: timing.as_dict() for name, timing in timings.items()},
+        }
+
+    def write(self, path: Path, seconds: float) -> None:
+        write_json(self.report(seconds), path)
+
+
+class _Timer:
+    __slots__ = ("metrics", "name", "start")
+
+    def __init__(self, metrics: Metrics, name: str) -> None:
+        self.metrics = metrics
+        self.name = name
+        self.start = 0.0
+
+    def __enter__(self) -> None:
+        if self.metrics.enabled:
+            self.start = time.perf_counter()
+
+    def __exit__(
+        self,
+        exc_type: type[BaseException] | None,
+        exc: BaseException | None,
+        tb: TracebackType | None,
+    ) -> None:
+        if self.metrics.enabled:
+            self.metrics.observe(self.name, time.perf_counter() - self.start)
+
+
+METRICS: Final = Metrics()
+"""The metrics that all modules record into."""
+
+
+def add_metrics_argument(parser: argparse.ArgumentParser) -> None:
+    """Add the ``--metrics FILE`` option, to be passed to `recording`."""
+    parser.add_argument(
+        "--metrics",
+        type=Path,
+        metavar="FILE",
+        help="write counts and timings of what the run did to this JSON file",
+    )
+
+
+@contextmanager
+def recording(path: Path | None) -> Iterator[None]:
+    """Record into `METRICS` within the block, and write a report to `path`.
+
+    Does nothing if `path` is None.
+    """
+    METRICS.enabled = path is not None
+    start = time.monotonic()
+    yield
+    if path is not None:
+        METRICS.write(path, time.monotonic() - start)
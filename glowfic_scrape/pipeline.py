@@ -0,0 +1,284 @@
+"""Download, illustrate and render threads in one go.
+
+Running `download_thread`, `download_images`, `to_html` and `to_ebook` one after
+the other, each waits for the one before to finish.  Here the posts of a thread
+go from the download straight to the HTML renderer through a queue, while the
+icons are fetched as soon as a post that uses them arrives, so all of this runs
+at once and takes about as long as the slowest part.  At the end, the icons are
+normalized, the HTML is pointed at the normalized icons and, if asked for, an
+EPUB book is made from the story file.
+"""
+import argparse
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import ExitStack
+import multiprocessing
+from pathlib import Path
+from queue import Queue
+import re
+import sys
+import threading
+import time
+from typing import Final, Iterator, NamedTuple, cast
+
+from . import download_images, download_thread, icons, to_ebook, to_html
+from .common_types import PostInfo, Url, get_image_filename
+from .http_client import add_client_arguments, configured
+from .icon_store import IconStore, default_path
+from .metrics import METRICS, add_metrics_argument, recording
+from .progress import Outcome, Progress, summarize
+from .render_cache import RenderCache
+
+QUEUE_POSTS: Final = 1024
+"""Most posts downloaded but not yet rendered; the download waits beyond that."""
+
+_ICON_SRC: Final = re.compile(r'src="images/([^"]+)"')
+_PAGE_LINK: Final = re.compile(r'<li><a href="([^"]+)"')
+
+_DONE: Final = object()
+
+
+class Result(NamedTuple):
+    story: Path
+    html: Path
+    icons: dict[Url, str | None]
+    """For each icon URL, `None` if the icon is there, or why it is not."""
+
+
+def run(
+    postid: int,
+    workers: int = 1,
+    jsonl: bool = False,
+    pool: Executor | None = None,
+    cache: RenderCache | None = None,
+    split: to_html.Split | None = None,
+    store: IconStore | None = None,
+    progress: Progress | None = None,
+) -> Result:
+    """Download a thread and its icons while rendering it to HTML.
+
+    The story file is written as by `download_thread.main`, the icons go into
+    `images` as with `download_images.process` and the HTML is written as by
+    `to_html.process`.
+    """
+    progress = progress or Progress()
+    header, posts = download_thread.iter_thread(postid, workers, progress)
+    images = Path(download_images.SUBDIR)
+    images.mkdir(exist_ok=True)
+    queue: Queue[object] = Queue(maxsize=QUEUE_POSTS)
+    stop = threading.Event()
+    fetches: dict[Url, Future[None]] = {}
+
+    with ThreadPoolExecutor(max_workers=download_images.WORKERS) as icon_pool:
+
+        def forward() -> Iterator[PostInfo]:
+            """Pass each post on to the renderer and start fetching its icon."""
+            for post in posts:
+                if stop.is_set():
+                    raise RuntimeError("rendering failed")
+                url = post.get("icon_url")
+                if url is not None and url not in fetches:
+                    fetches[url] = icon_pool.submit(
+                        download_images.download_image, url, images, store
+                    )
+                queue.put(post)
+                yield post
+
+        def download() -> Path:
+            try:
+                path = download_thread.save(postid, header, forward(), jsonl, progress)
+            except BaseException as e:
+                queue.put(e)
+                raise
+            queue.put(_DONE)
+            return path
+
+        ended = False
+
+        def received() -> Iterator[PostInfo]:
+            nonlocal ended
+            while True:
+                item = queue.get()
+                if item is _DONE or isinstance(item, BaseException):
+                    ended = True
+                    if isinstance(item, BaseException):
+                        raise RuntimeError("download failed") from item
+                    return
+                yield cast(PostInfo, item)
+
+        with ThreadPoolExecutor(max_workers=1) as downloader:
+            story = downloader.submit(download)
+            try:
+                html = to_html.write_html(header, received(), pool, cache, split)
+            except BaseException:
+                # let the download stop rather than wait for room in the queue
+                stop.set()
+                while not ended:
+                    item = queue.get()
+                    ended = item is _DONE or isinstance(item, BaseException)
+                raise
+            story_path = story.result()
+
+    results: dict[Url, str | None] = {}
+    for url, fetch in fetches.items():
+        try:
+            fetch.result()
+        except Exception as e:
+            results[url] = download_images.failure_reason(e)
+        else:
+            results[url] = None
+    return Result(story_path, html, results)
+
+
+def relink_icons(html: Path, split: bool, names: dict[str, str]) -> None:
+    """Point the icons in the HTML written by `run` at their normalized files.
+
+    The posts are rendered before their icons are there to be normalized, so
+    they show the icons as downloaded; `names` maps those to the files to show,
+    as `icons.normalize` returns.  With `split`, `html` is the index of pages.
+    """
+    files = [html]
+    if split:
+        files = [html.with_name(page) for page in _PAGE_LINK.findall(html.read_text())]
+    for path in files:
+        text = path.read_text()
+        relinked = _ICON_SRC.sub(
+            lambda m: f'src="images/{names.get(m.group(1), m.group(1))}"', text
+        )
+        if relinked != text:
+            path.write_text(relinked)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("postids", nargs="+", type=int, metavar="postid")
+    parser.add_argument(
+        "-j",
+        "--workers",
+        type=int,
+        default=1,
+        help="number of reply pages to fetch concurrently",
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=1,
+        help="number of processes to render with",
+    )
+    parser.add_argument(
+        "--jsonl",
+        action="store_true",
+        help="write stories as JSON Lines, one post per line",
+    )
+    parser.add_argument(
+        "--cache",
+        type=Path,
+        metavar="FILE",
+        help="reuse posts rendered before, keeping them in this cache file",
+    )
+    parser.add_argument(
+        "--split-posts",
+        type=int,
+        default=0,
+        metavar="N",
+        help="write pages of at most N posts, with an index",
+    )
+    parser.add_argument(
+        "--split-bytes",
+        type=int,
+        default=0,
+        metavar="N",
+        help="write pages of at most about N bytes, with an index",
+    )
+    parser.add_argument(
+        "--icon-size",
+        type=int,
+        default=icons.ICON_SIZE,
+        metavar="PIXELS",
+        help="shrink icons to at most this wide and high, if Pillow is installed; "
+        "0 to keep them as they are (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--icon-store",
+        type=Path,
+        nargs="?",
+        const=default_path(),
+        metavar="DIR",
+        help="keep icons once in this store shared by all stories, and link them "
+        "into images from there (default DIR: %(const)s)",
+    )
+    parser.add_argument(
+        "--ebook",
+        action="store_true",
+        help="also make an EPUB book of each story",
+    )
+    add_client_arguments(parser)
+    add_metrics_argument(parser)
+    args = parser.parse_args()
+    split = None
+    if args.split_posts or args.split_bytes:
+        split = to_html.Split(args.split_posts, args.split_bytes)
+    start = time.monotonic()
+    progress = Progress()
+    outcomes = []
+    with recording(args.metrics), ExitStack() as stack:
+        stack.enter_context(configured(args))
+        pool = None
+        if args.jobs > 1:
+            # the downloader and icon threads run while the pool starts workers,
+            # and a forked one could inherit a lock one of them holds
+            pool = stack.enter_context(
+                ProcessPoolExecutor(
+                    max_workers=args.jobs,
+                    mp_context=multiprocessing.get_context("spawn"),
+                )
+            )
+        cache = None
+        if args.cache is not None:
+            cache = stack.enter_context(RenderCache(args.cache))
+        store = None
+        if args.icon_store is not None:
+            store = stack.enter_context(IconStore(args.icon_store))
+        for postid in args.postids:
+            job = f"post {postid:d}"
+            begun = time.monotonic()
+            try:
+                result = run(
+                    postid,
+                    args.workers,
+                    args.jsonl,
+                    pool,
+                    cache,
+                    split,
+                    store,
+                    progress,
+                )
+                names = []
+                for url, error in result.icons.items():
+                    if error is not None:
+                        progress.log(f"{job}: {error}")
+                    else:
+                        names.append(get_image_filename(url))
+                with METRICS.timer("icons.normalize"):
+                    shown = icons.normalize(
+                        Path(download_images.SUBDIR), names, args.icon_size
+                    )
+                relink_icons(result.html, split is not None, shown)
+                # later stories and the EPUB show the icons as normalized just now
+                to_html.forget_icon_names()
+                output = result.html
+                if args.ebook:
+                    options = to_ebook.Options(cache=args.cache, jobs=args.jobs)
+                    output = to_ebook.convert(result.story, "epub", options)
+            except Exception as e:
+                progress.log(f"{job}: failed: {e}")
+                outcomes.append(
+                    Outcome(job, None, str(e) or repr(e), time.monotonic() - begun)
+                )
+            else:
+                outcomes.append(Outcome(job, output, None, time.monotonic() - begun))
+    if not summarize(outcomes, time.monotonic() - start):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
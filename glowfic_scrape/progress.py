@@ -0,0 +1,74 @@
+"""A status line on stderr for several jobs running at once, and a summary of
+how they went."""
+from pathlib import Path
+import shutil
+import sys
+import threading
+from typing import NamedTuple
+
+__all__ = ["Progress", "Outcome", "summarize"]
+
+
+class Progress:
+    """Shows how far along each running job is, on one line of stderr.
+
+    Messages written with `log` go above the status line, so they do not get
+    mixed up with it.  Thread-safe.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._jobs: dict[str, int] = {}
+        self._shown = 0
+
+    def update(self, job: str, percent: int) -> None:
+        with self._lock:
+            if self._jobs.get(job) != percent:
+                self._jobs[job] = percent
+                self._draw()
+
+    def finish(self, job: str) -> None:
+        with self._lock:
+            if self._jobs.pop(job, None) is not None:
+                self._draw()
+
+    def log(self, message: str) -> None:
+        with self._lock:
+            self._clear()
+            sys.stderr.write(message + "\n")
+            self._draw()
+
+    def _draw(self) -> None:
+        line = "  ".join(f"{job}: {p:3d} %" for job, p in self._jobs.items())
+        width = shutil.get_terminal_size().columns - 1
+        if len(line) > width:
+            line = line[: max(width - 3, 0)] + "..."
+        self._clear()
+        sys.stderr.write(line)
+        self._shown = len(line)
+
+    def _clear(self) -> None:
+        if self._shown:
+            sys.stderr.write("\r" + " " * self._shown + "\r")
+            self._shown = 0
+
+
+class Outcome(NamedTuple):
+    """How one job of a batch went."""
+
+    job: str
+    path: Path | None
+    error: str | None
+    seconds: float
+
+
+def summarize(outcomes: list[Outcome], seconds: float) -> bool:
+    """Write a summary of a batch to stderr; returns whether all jobs succeeded."""
+    failed = [o for o in outcomes if o.error is not None]
+    sys.stderr.write(
+        "%d of %d jobs done in %.1f s.\n"
+        % (len(outcomes) - len(failed), len(outcomes), seconds)
+    )
+    for o in failed:
+        sys.stderr.write(f"failed: {o.job}: {o.error}\n")
+    return not failed
@@ -0,0 +1,144 @@
+"""Compact in-memory stories.
+
+A `PostInfo` dict costs a hash table per post, plus its own copies of the author's
+and character's names and URLs.  `CompactStory` keeps each post as a slotted
+`Post` record instead, pointing to `Person` records shared by all posts of the
+same author or character, and derives reply permalinks from the post id.  The
+dict-shaped `Story` is available as a view, which builds the dicts on access.
+"""
+from typing import Final, Iterable, Iterator, Sequence, cast, overload
+
+from .common_types import HtmlCode, PostInfo, Story, StoryHeader, Url
+
+__all__ = ["Person", "Post", "CompactStory", "PostsView"]
+
+_REPLY_URL: Final = "https://www.glowfic.com/replies/{0:d}#reply-{0:d}"
+
+
+class Person:
+    """An author or a character."""
+
+    __slots__ = ("name", "url")
+
+    def __init__(self, name: str, url: Url | None) -> None:
+        self.name = name
+        self.url = url
+
+
+class Post:
+    __slots__ = ("id", "author", "character", "icon_url", "posted", "content", "_link")
+
+    def __init__(
+        self,
+        id: int,
+        author: Person,
+        character: Person | None,
+        icon_url: Url | None,
+        posted: str,
+        content: HtmlCode,
+        permalink: Url,
+    ) -> None:
+        self.id = id
+        self.author = author
+        self.character = character
+        self.icon_url = icon_url
+        self.posted = posted
+        self.content = content
+        # replies, i.e. almost all posts, have a permalink that follows from the id
+        self._link = None if permalink == _REPLY_URL.format(id) else permalink
+
+    @property
+    def permalink(self) -> Url:
+        return self._link or Url(_REPLY_URL.format(self.id))
+
+    def as_dict(self) -> PostInfo:
+        post: PostInfo = {
+            "id": self.id,
+            "permalink": self.permalink,
+            "author": self.author.name,
+            "author_url": cast(Url, self.author.url),
+            "posted": self.posted,
+            "content": self.content,
+        }
+        if self.character is not None:
+            post["character"] = self.character.name
+            if self.character.url is not None:
+                post["character_url"] = self.character.url
+        if self.icon_url is not None:
+            post["icon_url"] = self.icon_url
+        return post
+
+
+class CompactStory:
+    """A story whose posts are kept as `Post` records."""
+
+    def __init__(self, header: StoryHeader, posts: Iterable[PostInfo] = ()) -> None:
+        self.header = header
+        self.posts: list[Post] = []
+        self._people: dict[tuple[str, str | None], Person] = {}
+        self._icons: dict[str, Url] = {}
+        self.extend(posts)
+
+    def extend(self, posts: Iterable[PostInfo]) -> None:
+        self.posts += map(self._compact, posts)
+
+    def __len__(self) -> int:
+        return len(self.posts)
+
+    def __iter__(self) -> Iterator[PostInfo]:
+        return (post.as_dict() for post in self.posts)
+
+    def view(self) -> Story:
+        """The story as a `Story` dict, with the posts made into dicts on access."""
+        return cast(Story, {**self.header, "posts": PostsView(self.posts)})
+
+    def _compact(self, post: PostInfo) -> Post:
+        character = None
+        if "character" in post:
+            character = self._person(post["character"], post.get("character_url"))
+        icon_url = post.get("icon_url")
+        if icon_url is not None:
+            icon_url = self._icons.setdefault(icon_url, icon_url)
+        return Post(
+            post["id"],
+            self._person(post["author"], post["author_url"]),
+            character,
+            icon_url,
+            post["posted"],
+            post["content"],
+            post["permalink"],
+        )
+
+    def _person(self, name: str, url: Url | None) -> Person:
+        person = self._people.get((name, url))
+        if person is None:
+            person = self._people[name, url] = Person(name, url)
+        return person
+
+
+class PostsView(Sequence[PostInfo]):
+    """The posts of a `CompactStory` as a sequence of `PostInfo` dicts."""
+
+    __slots__ = ("_posts",)
+
+    def __init__(self, posts: list[Post]) -> None:
+        self._posts = posts
+
+    @overload
+    def __getitem__(self, index: int) -> PostInfo:
+        ...
+
+    @overload
+    def __getitem__(self, index: slice) -> list[PostInfo]:
+        ...
+
+    def __getitem__(self, index: int | slice) -> PostInfo | list[PostInfo]:
+        if isinstance(index, slice):
+            return [post.as_dict() for post in self._posts[index]]
+        return self._posts[index].as_dict()
+
+    def __len__(self) -> int:
+        return len(self._posts)
+
+    def __iter__(self) -> Iterator[PostInfo]:
+        return (post.as_dict() for post in self._posts)
@@ -0,0 +1,73 @@
+"""On-disk cache of rendered post fragments.
+
+Entries are keyed by a hash of everything the rendering of a post depends on, so
+that re-rendering a story after a sync only has to render the new or edited posts.
+The cache lives in a SQLite file and is kept below a size limit by evicting the
+least recently used entries.
+"""
+from pathlib import Path
+import sqlite3
+from typing import Final, Iterable
+
+from .lru import LRU
+
+__all__ = ["RenderCache", "DEFAULT_MAX_BYTES"]
+
+DEFAULT_MAX_BYTES: Final = 512 << 20
+
+_SCHEMA: Final = """
+CREATE TABLE IF NOT EXISTS fragments (
+    key TEXT PRIMARY KEY,
+    html TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    used INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS fragments_used ON fragments (used);
+"""
+
+
+class RenderCache:
+    """A size-bounded cache of HTML fragments in a SQLite file.
+
+    Evicts least recently used entries when closed.  Use one instance per thread.
+    """
+
+    def __init__(self, path: Path, max_bytes: int = DEFAULT_MAX_BYTES) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self._db = sqlite3.connect(path, timeout=60)
+        self._db.executescript(_SCHEMA)
+        self._lru = LRU(self._db, "fragments", "key")
+
+    def get_many(self, keys: Iterable[str]) -> dict[str, str]:
+        keys = list(keys)
+        found: dict[str, str] = {}
+        for i in range(0, len(keys), 500):
+            batch = keys[i : i + 500]
+            found.update(
+                self._db.execute(
+                    "SELECT key, html FROM fragments WHERE key IN (%s)"
+                    % ",".join("?" * len(batch)),
+                    batch,
+                )
+            )
+        self._lru.use(found)
+        return found
+
+    def put_many(self, items: Iterable[tuple[str, str]]) -> None:
+        with self._db:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO fragments VALUES (?, ?, ?, ?)",
+                ((key, html, len(html), self._lru.now) for key, html in items),
+            )
+
+    def close(self) -> None:
+        with self._db:
+            self._lru.close(self.max_bytes)
+        self._db.close()
+
+    def __enter__(self) -> "RenderCache":
+        return self
+
+    def __exit__(self, *exc: object) -> None:
+        self.close()
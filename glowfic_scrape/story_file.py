@@ -0,0 +1,267 @@
+"""Reading and writing story files.
+
+A story is stored either as one JSON object (`.json`), or as JSON Lines
+(`.jsonl`): a header record with the title, authors and comments URL, followed by
+one post per line.  JSON Lines files can be written as posts arrive.  Both formats
+are read back one post at a time, so that memory use doesn't grow with the length
+of the story.  A path like ``archive.sqlite#4582`` names a story in a
+`story_store` database instead.
+"""
+from contextlib import contextmanager
+import json
+import os
+from pathlib import Path
+import tempfile
+from typing import Any, Final, Iterable, Iterator, TextIO
+
+from .common_types import PostInfo, Story, StoryHeader
+from .records import CompactStory
+from .story_store import (
+    StoryStore,
+    is_store_path,
+    read_stored_story,
+    split_store_path,
+)
+
+__all__ = [
+    "JSONL_SUFFIX",
+    "is_jsonl",
+    "read_story",
+    "read_header",
+    "load_story",
+    "load_compact",
+    "write_story",
+    "create_jsonl",
+    "append_jsonl",
+    "append_posts",
+    "write_json",
+]
+
+JSONL_SUFFIX: Final = ".jsonl"
+CHUNK_SIZE: Final = 1 << 16
+
+_HEADER_KEYS: Final = ("title", "authors", "comments")
+_WHITESPACE: Final = " \t\n\r"
+_decoder: Final = json.JSONDecoder()
+
+
+def is_jsonl(path: Path) -> bool:
+    return path.suffix == JSONL_SUFFIX
+
+
+def read_story(path: Path) -> tuple[StoryHeader, Iterator[PostInfo]]:
+    """Return the header of a story file and an iterator over its posts.
+
+    The posts are read lazily.  In a JSON Lines file, a last line without a line
+    break (left behind by an interrupted download) is ignored.  In a JSON file,
+    posts that come before the header fields are held in memory.
+    """
+    if is_store_path(path):
+        return read_stored_story(*split_store_path(path))
+    f = path.open("r")
+    try:
+        if is_jsonl(path):
+            header: StoryHeader = json.loads(f.readline())
+            return header, _iter_posts(f)
+        return _read_json(f)
+    except BaseException:
+        f.close()
+        raise
+
+
+def read_header(path: Path) -> StoryHeader:
+    """Return the header of a story file, without reading its posts."""
+    if is_store_path(path):
+        db, thread = split_store_path(path)
+        with StoryStore(db) as store:
+            return store.header(thread)
+    with path.open("r") as f:
+        if is_jsonl(path):
+            header: StoryHeader = json.loads(f.readline())
+            return header
+        return _read_json(f)[0]
+
+
+def load_story(path: Path) -> Story:
+    header, posts = read_story(path)
+    return {**header, "posts": list(posts)}
+
+
+def load_compact(path: Path) -> CompactStory:
+    """Read a story into a `CompactStory`, which takes much less memory."""
+    header, posts = read_story(path)
+    return CompactStory(header, posts)
+
+
+def write_story(story: Story, path: Path) -> None:
+    """Write a story in the format given by the suffix of `path`, atomically."""
+    if is_store_path(path):
+        db, thread = split_store_path(path)
+        with StoryStore(db) as store:
+            store.put_header(thread, _header(story))
+            store.add_posts(thread, story["posts"])
+        return
+    with _replace(path) as o:
+        if is_jsonl(path):
+            o.write(json.dumps(_header(story)) + "\n")
+            append_posts(o, story["posts"])
+        else:
+            # post by post, so that the posts can be any sequence, such as
+            # the view of a `CompactStory`
+            o.write(json.dumps(_header(story))[:-1] + ', "posts": [')
+            for i, post in enumerate(story["posts"]):
+                o.write(", " + json.dumps(post) if i else json.dumps(post))
+            o.write("]}")
+
+
+def write_json(data: Any, path: Path) -> None:
+    """Write `data` as JSON, atomically."""
+    with _replace(path) as o:
+        json.dump(data, o, indent=1)
+
+
+def create_jsonl(path: Path, header: StoryHeader) -> TextIO:
+    """Start a JSON Lines story file; posts are then added with `append_posts`."""
+    o = path.open("w")
+    o.write(json.dumps(header) + "\n")
+    return o
+
+
+def append_jsonl(path: Path) -> TextIO:
+    """Open a JSON Lines story file for adding posts to the end."""
+    with path.open("rb+") as f:
+        # drop a line that an interrupted write left incomplete
+        data_end = f.seek(0, os.SEEK_END)
+        pos = data_end
+        while pos > 0:
+            step = min(4096, pos)
+            f.seek(pos - step)
+            chunk = f.read(step)
+            newline = chunk.rfind(b"\n")
+            if newline != -1:
+                pos = pos - step + newline + 1
+                break
+            pos -= step
+        if pos != data_end:
+            f.truncate(pos)
+    return path.open("a")
+
+
+def append_posts(o: TextIO, posts: Iterable[PostInfo]) -> None:
+    o.write("".join(json.dumps(post) + "\n" for post in posts))
+
+
+@contextmanager
+def _replace(path: Path) -> Iterator[TextIO]:
+    """Open a file that replaces `path` once it has been written completely."""
+    fd, tmpname = tempfile.mkstemp(dir=path.parent, prefix=path.name, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as o:
+            yield o
+        os.replace(tmpname, path)
+    except BaseException:
+        os.unlink(tmpname)
+        raise
+
+
+def _iter_posts(f: TextIO) -> Iterator[PostInfo]:
+    with f:
+        for line in f:
+            if not line.endswith("\n"):
+                break
+            yield json.loads(line)
+
+
+def _read_json(f: TextIO) -> tuple[StoryHeader, Iterator[PostInfo]]:
+    scanner = _Scanner(f)
+    scanner.expect("{")
+    fields: dict[str, Any] = {}
+    posts: list[PostInfo] = []
+    while scanner.peek() != "}":
+        key = scanner.value()
+        scanner.expect(":")
+        if key != "posts":
+            fields[key] = scanner.value()
+        elif all(k in fields for k in _HEADER_KEYS):
+            return _header(fields), _iter_array(scanner, f)
+        else:
+            posts = list(_iter_array(scanner))
+        if scanner.peek() == ",":
+            scanner.expect(",")
+    f.close()
+    return _header(fields), iter(posts)
+
+
+def _iter_array(scanner: "_Scanner", f: TextIO | None = None) -> Iterator[Any]:
+    """Yield the elements of the array at the scanner's position, closing `f` after."""
+    try:
+        scanner.expect("[")
+        if scanner.peek() == "]":
+            scanner.expect("]")
+            return
+        while True:
+            yield scanner.value()
+            if scanner.peek() == "]":
+                scanner.expect("]")
+                return
+            scanner.expect(",")
+    finally:
+        if f is not None:
+            f.close()
+
+
+class _Scanner:
+    """Incremental reader of JSON values from a file, one chunk at a time."""
+
+    def __init__(self, f: TextIO) -> None:
+        self.f = f
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+
+    def peek(self) -> str:
+        """Skip whitespace and return the next character ("" at end of file)."""
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in _WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buf) or not self._fill():
+                return self.buf[self.pos : self.pos + 1]
+
+    def expect(self, char: str) -> None:
+        if self.peek() != char:
+            raise ValueError(f"expected {char!r} in story file {self.f.name!r}")
+        self.pos += 1
+
+    def value(self) -> Any:
+        self.peek()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError:
+                if not self._fill():
+                    raise
+                continue
+            # a number at the end of the buffer may continue in the next chunk
+            if end < len(self.buf) or not self._fill():
+                self.pos = end
+                return value
+
+    def _fill(self) -> bool:
+        """Read more of the file; the read size grows with the pending value."""
+        if self.eof:
+            return False
+        chunk = self.f.read(max(CHUNK_SIZE, len(self.buf) - self.pos))
+        if not chunk:
+            self.eof = True
+            return False
+        self.buf = self.buf[self.pos :] + chunk
+        self.pos = 0
+        return True
+
+
+def _header(story: Story | dict[str, Any]) -> StoryHeader:
+    return {
+        "title": story["title"],
+        "authors": story["authors"],
+        "comments": story["comments"],
+    }
@@ -0,0 +1,261 @@
+"""Many stories in one SQLite database.
+
+Threads, posts, users, characters and icons each get a table, and posts are
+indexed by thread, post id, author, character and time of posting, so that
+single posts or threads can be looked up without reading everything else.
+
+Wherever a story file is accepted, a story in a store can be given as the path
+of the database, ``#`` and the id of the thread, e.g. ``archive.sqlite#4582``.
+Posts are read back one at a time from a query, in thread order.
+"""
+from pathlib import Path
+import sqlite3
+from typing import Final, Iterable, Iterator
+
+from .common_types import PostInfo, StoryHeader, Url
+
+__all__ = [
+    "STORE_SUFFIXES",
+    "StoryStore",
+    "is_store_path",
+    "split_store_path",
+    "store_path",
+    "read_stored_story",
+]
+
+STORE_SUFFIXES: Final = (".sqlite", ".db")
+
+_SCHEMA: Final = """
+PRAGMA journal_mode = WAL;
+PRAGMA foreign_keys = ON;
+CREATE TABLE IF NOT EXISTS threads (
+    id INTEGER PRIMARY KEY,
+    title TEXT NOT NULL,
+    authors TEXT NOT NULL,
+    comments TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS users (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    url TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS characters (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    url TEXT NOT NULL,
+    UNIQUE (url, name)
+);
+CREATE TABLE IF NOT EXISTS icons (
+    id INTEGER PRIMARY KEY,
+    url TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS posts (
+    thread INTEGER NOT NULL REFERENCES threads (id) ON DELETE CASCADE,
+    seq INTEGER NOT NULL,
+    id INTEGER NOT NULL,
+    author INTEGER NOT NULL REFERENCES users (id),
+    character INTEGER REFERENCES characters (id),
+    icon INTEGER REFERENCES icons (id),
+    permalink TEXT NOT NULL,
+    posted TEXT NOT NULL,
+    content TEXT NOT NULL,
+    UNIQUE (thread, seq)
+);
+CREATE INDEX IF NOT EXISTS posts_id ON posts (id);
+CREATE INDEX IF NOT EXISTS posts_author ON posts (author);
+CREATE INDEX IF NOT EXISTS posts_character ON posts (character);
+CREATE INDEX IF NOT EXISTS posts_posted ON posts (posted);
+"""
+
+_SELECT_POSTS: Final = """
+SELECT p.id, p.permalink, u.name, u.url, p.posted, p.content, c.name, c.url, i.url
+FROM posts p
+JOIN users u ON u.id = p.author
+LEFT JOIN characters c ON c.id = p.character
+LEFT JOIN icons i ON i.id = p.icon
+WHERE p.thread = ?
+ORDER BY p.seq
+"""
+
+
+def is_store_path(path: Path) -> bool:
+    """Whether `path` names a thread in a store, like ``archive.sqlite#4582``."""
+    db, sep, thread = str(path).rpartition("#")
+    return bool(sep) and db.endswith(STORE_SUFFIXES) and thread.isdecimal()
+
+
+def split_store_path(path: Path) -> tuple[Path, int]:
+    db, _, thread = str(path).rpartition("#")
+    return Path(db), int(thread)
+
+
+def store_path(db: Path, thread: int) -> Path:
+    return Path(f"{db}#{thread:d}")
+
+
+def read_stored_story(db: Path, thread: int) -> tuple[StoryHeader, Iterator[PostInfo]]:
+    """Return the header of a stored story and an iterator over its posts.
+
+    The posts are fetched from the database as the iterator is consumed.
+    """
+    store = StoryStore(db)
+    try:
+        header = store.header(thread)
+    except BaseException:
+        store.close()
+        raise
+    return header, _closing(store, store.posts(thread))
+
+
+def _closing(store: "StoryStore", posts: Iterator[PostInfo]) -> Iterator[PostInfo]:
+    with store:
+        yield from posts
+
+
+class StoryStore:
+    """A SQLite database of stories.
+
+    Several instances (in different threads or processes) may use the same
+    database; writes are serialized by SQLite.  Use one instance per thread.
+    """
+
+    def __init__(self, path: Path) -> None:
+        if not path.exists():
+            path.parent.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(path, timeout=60)
+        self._db.executescript(_SCHEMA)
+        self._ids: dict[tuple[str, str, str], int] = {}
+
+    def threads(self) -> list[tuple[int, str]]:
+        """The ids and titles of all stored threads."""
+        return self._db.execute(
+            "SELECT id, title FROM threads ORDER BY id"
+        ).fetchall()
+
+    def header(self, thread: int) -> StoryHeader:
+        row = self._db.execute(
+            "SELECT title, authors, comments FROM threads WHERE id = ?", (thread,)
+        ).fetchone()
+        if row is None:
+            raise KeyError(f"no thread {thread:d} in the store")
+        title, authors, comments = row
+        return {"title": title, "authors": authors, "comments": Url(comments)}
+
+    def posts(self, thread: int) -> Iterator[PostInfo]:
+        """The posts of a thread, in order, fetched as they are consumed."""
+        for row in self._db.execute(_SELECT_POSTS, (thread,)):
+            post_id, permalink, author, author_url, posted, content = row[:6]
+            character, character_url, icon_url = row[6:]
+            post: PostInfo = {
+                "id": post_id,
+                "permalink": permalink,
+                "author": author,
+                "author_url": author_url,
+                "posted": posted,
+                "content": content,
+            }
+            if character is not None:
+                post["character"] = character
+                if character_url:
+                    post["character_url"] = character_url
+            if icon_url is not None:
+                post["icon_url"] = icon_url
+            yield post
+
+    def reply_ids(self, thread: int) -> set[int]:
+        """The ids of the posts of a thread, except the first one."""
+        return {
+            post_id
+            for (post_id,) in self._db.execute(
+                "SELECT id FROM posts WHERE thread = ? AND seq > 0", (thread,)
+            )
+        }
+
+    def put_header(self, thread: int, header: StoryHeader) -> None:
+        """Start storing a thread, replacing any posts stored for it before."""
+        with self._db:
+            self._db.execute("DELETE FROM posts WHERE thread = ?", (thread,))
+            self._db.execute(
+                "INSERT OR REPLACE INTO threads VALUES (?, ?, ?, ?)",
+                (thread, header["title"], header["authors"], header["comments"]),
+            )
+
+    def add_posts(self, thread: int, posts: Iterable[PostInfo]) -> None:
+        """Append posts to a thread, in one transaction."""
+        try:
+            with self._db:
+                (seq,) = self._db.execute(
+                    "SELECT COALESCE(MAX(seq) + 1, 0) FROM posts WHERE thread = ?",
+                    (thread,),
+                ).fetchone()
+                rows = [self._row(thread, i, post) for i, post in enumerate(posts, seq)]
+                self._db.executemany(
+                    "INSERT INTO posts VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows
+                )
+        except BaseException:
+            # the ids of rows added in the failed transaction are gone
+            self._ids.clear()
+            raise
+
+    def close(self) -> None:
+        self._db.close()
+
+    def __enter__(self) -> "StoryStore":
+        return self
+
+    def __exit__(self, *exc: object) -> None:
+        self.close()
+
+    def _row(self, thread: int, seq: int, post: PostInfo) -> tuple[object, ...]:
+        character = None
+        if "character" in post:
+            character = self._character_id(
+                post["character"], post.get("character_url", "")
+            )
+        icon = self._icon_id(post["icon_url"]) if "icon_url" in post else None
+        return (
+            thread,
+            seq,
+            post["id"],
+            self._user_id(post["author"], post["author_url"]),
+            character,
+            icon,
+            post["permalink"],
+            post["posted"],
+            post["content"],
+        )
+
+    def _user_id(self, name: str, url: str) -> int:
+        key = ("users", name, url)
+        if key not in self._ids:
+            # a user can change their name; the URL stays
+            self._db.execute(
+                "INSERT INTO users (name, url) VALUES (?, ?)"
+                " ON CONFLICT (url) DO UPDATE SET name = excluded.name",
+                (name, url),
+            )
+            self._ids[key] = self._db.execute(
+                "SELECT id FROM users WHERE url = ?", (url,)
+            ).fetchone()[0]
+        return self._ids[key]
+
+    def _character_id(self, name: str, url: str) -> int:
+        key = ("characters", name, url)
+        if key not in self._ids:
+            self._db.execute(
+                "INSERT OR IGNORE INTO characters (name, url) VALUES (?, ?)",
+                (name, url),
+            )
+            self._ids[key] = self._db.execute(
+                "SELECT id FROM characters WHERE url = ? AND name = ?", (url, name)
+            ).fetchone()[0]
+        return self._ids[key]
+
+    def _icon_id(self, url: str) -> int:
+        key = ("icons", "", url)
+        if key not in self._ids:
+            self._db.execute("INSERT OR IGNORE INTO icons (url) VALUES (?)", (url,))
+            self._ids[key] = self._db.execute(
+                "SELECT id FROM icons WHERE url = ?", (url,)
+            ).fetchone()[0]
+        return self._ids[key]
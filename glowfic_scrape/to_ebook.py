@@ -1,20 +1,251 @@
 #!/usr/bin/env python
 
+import argparse
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import ExitStack
+from functools import partial
+import hashlib
+import json
+import multiprocessing
+from multiprocessing.connection import Connection
+import os
+from pathlib import Path
 import re
+import signal
 import subprocess
 import sys
-from typing import Final
+import threading
+import time
+from typing import Callable, Final, NamedTuple
 
+from . import to_html
 from .common_types import HtmlCode
+from .epub import CHAPTER_SPLIT, write_epub
+from .metrics import METRICS, add_metrics_argument, recording
+from .progress import Outcome, summarize
+from .render_cache import RenderCache
+from .story_file import read_header, read_story, write_json
 
-## Depends on having Calibre's `ebook-convert` in your PATH.
+## Only needed for HTML files, formats other than EPUB and `--calibre`: stories
+## are written as EPUB directly.  Depends on having Calibre's `ebook-convert` in
+## your PATH.
 ## On MacOS, install Calibre then:
 ##   export PATH="${PATH}:/Applications/calibre.app/Contents/MacOS"
 ## On Debian, `sudo apt install calibre` should do it.
 EBOOK_CONVERT: Final = "ebook-convert"
+CALIBRE_OPTIONS: Final = [
+    "--chapter",
+    "//*[name()='h1' or name()='h2' or name()='h3']",
+    "--language",
+    "en_us",
+]
+HTML_SUFFIXES: Final = (".html", ".htm")
+IMAGES: Final = Path("images")
 
+MANIFEST: Final = ".ebooks.json"
+"""Where `batch` keeps the hash of the input of each book it made."""
 
-def ebook_convert(src: str) -> None:
+_PROCESSES: Final = multiprocessing.get_context("spawn")
+"""How `_isolated` starts processes: forking while `batch`'s threads run could
+copy a lock some thread holds, and leave the child stuck on it."""
+
+
+class Options(NamedTuple):
+    """How books are made."""
+
+    split: to_html.Split = CHAPTER_SPLIT
+    cache: Path | None = None
+    calibre: bool = False
+    jobs: int = 1
+    """Number of processes to render the posts of a book with."""
+
+
+class Job(NamedTuple):
+    src: Path
+    fmt: str
+
+
+def convert(src: Path, fmt: str = "epub", options: Options = Options()) -> Path:
+    """Make a book of a story file, or of an HTML file made by `to_html`.
+
+    Story files are written as EPUB directly, unless `options.calibre` is set;
+    HTML files, other formats and stories rendered to HTML with `calibre` are
+    converted by Calibre.
+    """
+    if src.suffix in HTML_SUFFIXES:
+        return ebook_convert(str(src), fmt)
+    if needs_calibre(Job(src, fmt), options):
+        html = to_html.process(str(src), cache=options.cache)
+        return ebook_convert(str(html), fmt)
+    header, posts = read_story(src)
+    output = Path(to_html.base_name(header) + ".epub")
+    with ExitStack() as stack:
+        pool = None
+        if options.jobs > 1:
+            pool = stack.enter_context(ProcessPoolExecutor(max_workers=options.jobs))
+        render_cache = None
+        if options.cache is not None:
+            render_cache = stack.enter_context(RenderCache(options.cache))
+        with METRICS.timer("ebook.epub"):
+            write_epub(header, posts, output, options.split, pool, render_cache)
+    sys.stderr.write('wrote to "%s".\n' % output)
+    return output
+
+
+def needs_calibre(job: Job, options: Options) -> bool:
+    return options.calibre or job.fmt != "epub" or job.src.suffix in HTML_SUFFIXES
+
+
+def output_path(job: Job) -> Path:
+    if job.src.suffix in HTML_SUFFIXES:
+        return job.src.with_suffix("." + job.fmt)
+    return Path(to_html.base_name(read_header(job.src)) + "." + job.fmt)
+
+
+def input_hash(job: Job, options: Options) -> str:
+    """Hash of everything the book made by `job` depends on.
+
+    That is the story or HTML file, which of the icons it uses are in `IMAGES`,
+    and the options that apply to the job.
+    """
+    calibre = needs_calibre(job, options)
+    settings = [job.fmt, CALIBRE_OPTIONS if calibre else list(options.split)]
+    h = hashlib.sha256(json.dumps(settings).encode("utf8"))
+    if job.src.suffix in HTML_SUFFIXES:
+        data = job.src.read_bytes()
+        h.update(data)
+        icons = {m.decode() for m in re.findall(rb'src="images/([^"]+)"', data)}
+    else:
+        h.update(str(to_html.RENDERER_VERSION).encode("utf8"))
+        header, posts = read_story(job.src)
+        h.update(json.dumps(header).encode("utf8"))
+        icons = set()
+        for post in posts:  # read to the end, which closes the story file
+            h.update(json.dumps(post).encode("utf8"))
+            if "icon_url" in post:
+                icons.add(to_html.icon_file(post["icon_url"]))
+    for name in sorted(icons):
+        h.update(f"{name}: {(IMAGES / name).exists()}\n".encode("utf8"))
+    return h.hexdigest()
+
+
+def batch(
+    stories: list[Path],
+    formats: list[str],
+    options: Options = Options(),
+    parallel: int = 1,
+    timeout: float | None = None,
+    force: bool = False,
+) -> list[Outcome]:
+    """Make a book in each of `formats` of each of `stories`.
+
+    Each book is made in a process of its own, up to `parallel` at once, and is
+    killed (with any Calibre it started) after `timeout` seconds.  A book whose
+    input (see `input_hash`) did not change since it was last made successfully
+    is skipped, unless `force` is set.  Stories converted with Calibre are
+    rendered to HTML once for all formats.  A job that fails is reported and
+    does not stop the others.  The outcomes are in the order of the jobs.
+    """
+    manifest_path = Path(MANIFEST)
+    made: dict[str, str] = {}
+    if manifest_path.exists():
+        made = json.loads(manifest_path.read_text())
+    lock = threading.Lock()
+    renders: dict[Path, Future[Path]] = {}
+
+    def render(src: Path) -> Path:
+        """Render a story to HTML, or wait for the job that is rendering it."""
+        with lock:
+            future = renders.get(src)
+            mine = future is None
+            if future is None:
+                future = renders[src] = Future()
+        if mine:
+            try:
+                html = partial(to_html.process, str(src), cache=options.cache)
+                future.set_result(_isolated(html, timeout))
+            except Exception as e:
+                future.set_exception(e)
+        return future.result()
+
+    def run(job: Job) -> Outcome:
+        name = f"{job.src} ({job.fmt})"
+        start = time.monotonic()
+        output = None
+        try:
+            output = output_path(job)
+            digest = input_hash(job, options)
+            if not force and made.get(str(output)) == digest and output.exists():
+                METRICS.count("ebook.up_to_date")
+                sys.stderr.write('"%s" is up to date.\n' % output)
+                return Outcome(name, output, None, 0.0)
+            src = job.src
+            if needs_calibre(job, options) and src.suffix not in HTML_SUFFIXES:
+                src = render(src)
+            _isolated(partial(convert, src, job.fmt, options), timeout)
+        except Exception as e:
+            if output is not None:
+                with lock:
+                    made.pop(str(output), None)
+            METRICS.count("ebook.failed")
+            sys.stderr.write(f"{name}: failed: {e}\n")
+            return Outcome(name, None, str(e) or repr(e), time.monotonic() - start)
+        METRICS.count("ebook.made")
+        with lock:
+            made[str(output)] = digest
+        return Outcome(name, output, None, time.monotonic() - start)
+
+    jobs = [Job(src, fmt) for src in stories for fmt in formats]
+    try:
+        with ThreadPoolExecutor(max_workers=max(parallel, 1)) as pool:
+            return list(pool.map(run, jobs))
+    finally:
+        write_json(made, manifest_path)
+
+
+def _isolated(fn: Callable[[], Path], timeout: float | None) -> Path:
+    """Call `fn` in a new process, killing it and its children after `timeout`."""
+    receiver, sender = _PROCESSES.Pipe(duplex=False)
+    process = _PROCESSES.Process(
+        target=_call, args=(fn, sender, METRICS.enabled)
+    )
+    process.start()
+    sender.close()
+    try:
+        if not receiver.poll(timeout):
+            raise TimeoutError(f"timed out after {timeout:g} s")
+        ok, result, metrics = receiver.recv()
+        if metrics is not None:
+            METRICS.merge(metrics)
+    except EOFError:
+        ok, result = False, None
+    finally:
+        if process.is_alive():
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except ProcessLookupError:  # before it started its session
+                process.kill()
+        process.join()
+        receiver.close()
+    if not ok:
+        raise RuntimeError(result or f"worker died with exit code {process.exitcode}")
+    return result
+
+
+def _call(fn: Callable[[], Path], sender: Connection, metrics: bool) -> None:
+    # a session of its own, so that Calibre can be killed along with the worker
+    os.setsid()
+    METRICS.take()  # anything inherited from the parent is counted there
+    METRICS.enabled = metrics
+    try:
+        result = fn()
+    except Exception as e:
+        sender.send((False, str(e) or repr(e), METRICS.take() if metrics else None))
+    else:
+        sender.send((True, result, METRICS.take() if metrics else None))
+
+
+def ebook_convert(src: str, fmt: str = "epub") -> Path:
     with open(src) as f:
         contents = HtmlCode(f.read())
     info: dict[str, str] = {}
@@ -23,22 +254,106 @@ def ebook_convert(src: str) -> None:
         if m:
             info[field] = m.group(1)
 
-    name = re.sub(r"\.html$", "", src)
-    for fmt in ["epub"]:  # ["mobi", "epub"]:
-        output = "%s.%s" % (name, fmt)
-        options = [
-            "--chapter",
-            "//*[name()='h1' or name()='h2' or name()='h3']",
-            "--language",
-            "en_us",
-        ]
-        for field, value in info.items():
-            options += ["--" + field, value]
-        cmd = [EBOOK_CONVERT, src, output] + options
-        print(cmd)
+    output = Path(src).with_suffix("." + fmt)
+    options = list(CALIBRE_OPTIONS)
+    for field, value in info.items():
+        options += ["--" + field, value]
+    cmd = [EBOOK_CONVERT, src, str(output)] + options
+    print(cmd)
+    with METRICS.timer("ebook.calibre"):
         subprocess.run(cmd, check=True)
+    return output
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Make ebooks of stories.")
+    parser.add_argument(
+        "stories",
+        nargs="+",
+        type=Path,
+        metavar="story",
+        help="a story file, or an HTML file made by to_html",
+    )
+    parser.add_argument(
+        "-f",
+        "--format",
+        action="append",
+        dest="formats",
+        metavar="FORMAT",
+        help="make books in this format (default: epub); can be repeated; "
+        "formats other than epub are made by Calibre",
+    )
+    parser.add_argument(
+        "-p",
+        "--parallel",
+        type=int,
+        default=1,
+        help="number of books to make at once (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        metavar="SECONDS",
+        help="give up on a book after this long (default: no limit)",
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="make books even if their input did not change since the last time",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help="number of processes to render the posts of each book with",
+    )
+    parser.add_argument(
+        "--cache",
+        type=Path,
+        metavar="FILE",
+        help="reuse posts rendered before, keeping them in this cache file",
+    )
+    parser.add_argument(
+        "--split-posts",
+        type=int,
+        default=CHAPTER_SPLIT.posts,
+        metavar="N",
+        help="start a new chapter after N posts",
+    )
+    parser.add_argument(
+        "--split-bytes",
+        type=int,
+        default=CHAPTER_SPLIT.bytes,
+        metavar="N",
+        help="start a new chapter before N bytes of posts (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--calibre",
+        action="store_true",
+        help="render to HTML and convert it with Calibre's ebook-convert",
+    )
+    add_metrics_argument(parser)
+    args = parser.parse_args()
+    options = Options(
+        to_html.Split(args.split_posts, args.split_bytes),
+        args.cache,
+        args.calibre,
+        args.jobs,
+    )
+    start = time.monotonic()
+    with recording(args.metrics):
+        outcomes = batch(
+            args.stories,
+            args.formats or ["epub"],
+            options,
+            args.parallel,
+            args.timeout,
+            args.force,
+        )
+    if not summarize(outcomes, time.monotonic() - start):
+        sys.exit(1)
 
 
 if __name__ == "__main__":
-    for arg in sys.argv[1:]:
-        ebook_convert(arg)
+    main()
@@ -1,15 +1,31 @@
 #! /usr/bin/env python
 
+import argparse
+from collections import deque
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import ExitStack
 import datetime
+from functools import cache
+import hashlib
+import heapq
+from itertools import islice
 import json
+import multiprocessing
+from pathlib import Path
 import re
 import sys
-from typing import Final, Iterable
+import time
+from typing import Final, Iterable, Iterator, NamedTuple, TextIO
 
 import lxml.html
-from .smartypants import Attr, smartypants
+from lxml.html import defs
+from .typography import smarten_tree
 
-from .common_types import HtmlCode, Story, Url, get_image_filename
+from .common_types import HtmlCode, PostInfo, StoryHeader, Url, get_image_filename
+from .icons import icon_names
+from .metrics import METRICS, Snapshot, add_metrics_argument, recording
+from .render_cache import RenderCache
+from .story_file import read_story
 
 TEMPLATE: Final = HtmlCode(
     """
@@ -23,7 +39,7 @@ TEMPLATE: Final = HtmlCode(
 """
 )
 
-HEADER: Final = HtmlCode(
+HEAD: Final = HtmlCode(
     """<!DOCTYPE html>
 <html lang="en">
 <head>
@@ -50,25 +66,168 @@ span.character-pic img{{width:100px;max-height:200px;}}
 span.character-name{{font-weight:bold;}}
 div.spoiler{{border: 2px solid black;margin:4px 0;padding:4px;}}
 p.spoiler-summary{{font-weight:bold;margin-bottom:8px;text-align:center;}}
+nav.pages{{text-align:center;margin:1em 0;}}
 </style>
 </head>
 <body>
-<h1>{title}</h1>
+"""
+)
+
+HEADER: Final = HtmlCode(
+    HEAD
+    + """<h1>{title}</h1>
 <div>{authors}</div>
 <div>{comments}</div>
 <hr>
 """
 )
 
+PAGE_HEADER: Final = HtmlCode(
+    HEAD
+    + """<nav class="pages">{nav}</nav>
+<h2>{chapter}</h2>
+<hr>
+"""
+)
+"""The start of one page of a story split into pages; the `<h2>` is what
+`to_ebook` takes as the start of a chapter."""
+
+PAGE_FOOTER: Final = HtmlCode(
+    """<nav class="pages">{nav}</nav>
+</body>
+</html>
+"""
+)
+
 
-PARAGRAPH_TWO_BRS: Final = re.compile(r"\s*((<br\s*/?>|\n)\s*){2,}", flags=re.I)
+class Split(NamedTuple):
+    """Where to start a new page: after this many posts or bytes; 0 for no limit."""
 
+    posts: int = 0
+    bytes: int = 0
 
-def process(filename: str):
-    with open(filename, "r") as f:
-        thread: Story = json.load(f)
-    ofilename = re.sub(r"\W+", "_", thread["title"]) + ".html"
-    with open(ofilename, "w") as o:
+
+RENDERER_VERSION: Final = 3
+"""Change this whenever a change to the code changes the rendering of posts."""
+
+CHUNK_POSTS: Final = 64
+"""Number of posts handed to a worker process at once."""
+MAX_PENDING_CHUNKS: Final = 64
+POST_BUDGET: Final = 1.0
+"""Seconds a post may take to render before it is reported as slow."""
+SLOWEST_POSTS: Final = 10
+"""Number of slow posts listed at the end of rendering a story."""
+
+_Rendered = tuple[list[HtmlCode], list[float], Snapshot | None]
+"""Posts rendered by a worker, the seconds each took, and the metrics it recorded
+meanwhile."""
+
+_SPACE: Final = re.compile(r"\s+")
+_BLOCK_TAGS: Final = defs.block_tags - {"del", "ins"}
+_EMPTY_KEPT: Final = frozenset(["hr", "img"])
+"""Elements kept in a post even though they have no content, unlike empty
+paragraphs."""
+
+
+def process(
+    filename: str,
+    pool: Executor | None = None,
+    cache: Path | None = None,
+    split: Split | None = None,
+) -> Path:
+    """Render a story file to HTML, one post at a time, and return the output path.
+
+    With a process pool, chunks of posts are rendered in its workers.  With a cache
+    file, posts rendered before are taken from the cache.  With `split`, the story
+    is written as a series of pages, and the returned file is an index of them.
+    """
+    thread, posts = read_story(Path(filename))
+    with ExitStack() as stack:
+        render_cache = None
+        if cache is not None:
+            render_cache = stack.enter_context(RenderCache(cache))
+        return write_html(thread, posts, pool, render_cache, split)
+
+
+def write_html(
+    thread: StoryHeader,
+    posts: Iterable[PostInfo],
+    pool: Executor | None = None,
+    cache: RenderCache | None = None,
+    split: Split | None = None,
+) -> Path:
+    """Render a story to HTML as its posts come, like `process`."""
+    base = base_name(thread)
+    ofilename = Path(base + ".html")
+    if split is not None:
+        _write_pages(thread, posts, base, split, pool, cache)
+    else:
+        with ofilename.open("w") as o:
+            o.write(
+                HEADER.format(
+                    title=thread["title"],
+                    authors=thread["authors"],
+                    comments=thread["comments"],
+                )
+            )
+            for html in render_posts(posts, pool, cache):
+                o.write(html)
+            o.write("<hr>\n</body>\n</html>\n")
+    sys.stderr.write('wrote to "%s".\n' % ofilename)
+    return ofilename
+
+
+def base_name(thread: StoryHeader) -> str:
+    """The name of the output files for a story, without suffix."""
+    return re.sub(r"\W+", "_", thread["title"])
+
+
+def _write_pages(
+    thread: StoryHeader,
+    posts: Iterable[PostInfo],
+    base: str,
+    split: Split,
+    pool: Executor | None,
+    cache: RenderCache | None,
+) -> None:
+    """Write a story as pages ``<base>_001.html``, ... and an index ``<base>.html``.
+
+    All pages are in the current directory, so they share the `images` directory.
+    """
+    index = f"{base}.html"
+    pages: list[tuple[str, str, int]] = []  # file name, heading, first post
+    o: TextIO | None = None
+    number = 0
+    try:
+        for number, (new_page, posted, html) in enumerate(
+            paginate(posts, split, pool, cache), 1
+        ):
+            if new_page:
+                page = f"{base}_{len(pages) + 1:03d}.html"
+                if o is not None:
+                    o.write(PAGE_FOOTER.format(nav=_nav(index, pages[:-1], page)))
+                    o.close()
+                heading = f"Part {len(pages) + 1:d} &middot; {format_time(posted)}"
+                o = open(page, "w")
+                o.write(
+                    PAGE_HEADER.format(
+                        title=f"{thread['title']} &ndash; part {len(pages) + 1:d}",
+                        authors=thread["authors"],
+                        comments=thread["comments"],
+                        nav=_nav(index, pages, None),
+                        chapter=heading,
+                    )
+                )
+                pages.append((page, heading, number))
+            assert o is not None
+            o.write(html)
+        if o is not None:
+            o.write(PAGE_FOOTER.format(nav=_nav(index, pages[:-1], None)))
+    finally:
+        if o is not None:
+            o.close()
+
+    with open(index, "w") as o:
         o.write(
             HEADER.format(
                 title=thread["title"],
@@ -76,40 +235,329 @@ def process(filename: str):
                 comments=thread["comments"],
             )
         )
-        for post in thread["posts"]:
+        o.write('<ol class="pages">\n')
+        ends = [first - 1 for _, _, first in pages[1:]] + [number]
+        for (page, heading, first), last in zip(pages, ends):
             o.write(
-                TEMPLATE.format(
-                    postid=post["id"],
-                    # author=post["author"],
-                    # author_url=post["author_url"],
-                    picture=picture(post.get("icon_url")),
-                    character=character(post.get("character"), post["author"]),
-                    # posted=format_time(post["posted"]),
-                    # permalink=post["permalink"],
-                    content=clean_html(to_paragraphs(smartypants(post["content"], Attr.q | Attr.d))),
-                )
+                f'<li><a href="{page}">{heading}</a> '
+                f"(posts {first:d}&ndash;{last:d})</li>\n"
             )
-        o.write("<hr>\n</body>\n</html>\n")
-    sys.stderr.write('wrote to "%s".\n' % ofilename)
+        o.write("</ol>\n</body>\n</html>\n")
 
 
-def to_paragraphs(src: HtmlCode) -> HtmlCode:
-    return HtmlCode(
-        src
-        if ("<p>" in src or "<details>" in src)
-        else PARAGRAPH_TWO_BRS.sub("</p><p>", "<p>" + src + "</p>")
-    )
+def paginate(
+    posts: Iterable[PostInfo],
+    split: Split,
+    pool: Executor | None = None,
+    cache: RenderCache | None = None,
+) -> Iterator[tuple[bool, str, HtmlCode]]:
+    """Render posts like `render_posts`, marking where `split` starts a new page.
+
+    Yields for each post whether it starts a page, when it was posted and its HTML.
+    """
+    times: deque[str] = deque()
+
+    def timed() -> Iterator[PostInfo]:
+        for post in posts:
+            times.append(post["posted"])
+            yield post
+
+    count = size = 0
+    for html in render_posts(timed(), pool, cache):
+        length = len(html.encode("utf8"))
+        new_page = (
+            count == 0
+            or bool(split.posts and count >= split.posts)
+            or bool(split.bytes and size + length > split.bytes)
+        )
+        if new_page:
+            count = size = 0
+        count += 1
+        size += length
+        yield new_page, times.popleft(), html
+
+
+def _nav(index: str, before: list[tuple[str, str, int]], next_page: str | None) -> str:
+    """Links to the previous page (the last of `before`), the index and `next_page`."""
+    links = []
+    if before:
+        links.append(f'<a href="{before[-1][0]}" rel="prev">&larr; previous</a>')
+    links.append(f'<a href="{index}">contents</a>')
+    if next_page is not None:
+        links.append(f'<a href="{next_page}" rel="next">next &rarr;</a>')
+    return " &middot; ".join(links)
+
+
+def render_posts(
+    posts: Iterable[PostInfo],
+    pool: Executor | None = None,
+    cache: RenderCache | None = None,
+) -> Iterator[HtmlCode]:
+    """Render posts in order, optionally in chunks on a pool of workers.
 
+    No more than `MAX_PENDING_CHUNKS` chunks are queued at a time, so the posts are
+    still consumed as a stream.  Only the posts missing from `cache` are rendered.
+    Posts that take longer than `POST_BUDGET` to render are logged as they come,
+    and the slowest of them listed at the end.
+    """
+    slow = _SlowPosts()
+    if pool is None and cache is None:
+        for post in posts:
+            start = time.perf_counter()
+            html = render_post(post)
+            slow.add(post["id"], time.perf_counter() - start)
+            METRICS.count("render.posts")
+            yield html
+        slow.report()
+        return
+    pending: deque[
+        tuple[list[str], dict[str, str], list[int], Future[_Rendered]]
+    ] = deque()
+    it = iter(posts)
+    while chunk := list(islice(it, CHUNK_POSTS)):
+        keys: list[str] = []
+        hits: dict[str, str] = {}
+        missing = chunk
+        if cache is not None:
+            keys = [cache_key(post) for post in chunk]
+            hits = cache.get_many(keys)
+            missing = [post for post, key in zip(chunk, keys) if key not in hits]
+        if pool is None or not missing:
+            future: Future[_Rendered] = Future()
+            future.set_result((*_render_chunk(missing), None))
+        else:
+            future = pool.submit(_render_in_worker, missing, METRICS.enabled)
+        pending.append((keys, hits, [post["id"] for post in missing], future))
+        if len(pending) >= MAX_PENDING_CHUNKS or pool is None:
+            yield from _finish_chunk(*pending.popleft(), cache, slow)
+    while pending:
+        yield from _finish_chunk(*pending.popleft(), cache, slow)
+    slow.report()
+
+
+def _finish_chunk(
+    keys: list[str],
+    hits: dict[str, str],
+    ids: list[int],
+    future: Future[_Rendered],
+    cache: RenderCache | None,
+    slow: "_SlowPosts",
+) -> list[HtmlCode]:
+    rendered, seconds, metrics = future.result()
+    if metrics is not None:
+        METRICS.merge(metrics)
+    for postid, s in zip(ids, seconds):
+        slow.add(postid, s)
+    METRICS.count("render.posts", len(keys) or len(rendered))
+    METRICS.count("render.cache_hits", len(hits))
+    if cache is None:
+        return rendered
+    new = iter(rendered)
+    htmls = [HtmlCode(hits[key]) if key in hits else next(new) for key in keys]
+    cache.put_many((key, html) for key, html in zip(keys, htmls) if key not in hits)
+    return htmls
+
+
+def cache_key(post: PostInfo) -> str:
+    """Hash of everything `render_post` output depends on."""
+    fields = [
+        RENDERER_VERSION,
+        post["id"],
+        post["author"],
+        post.get("character"),
+        picture(post.get("icon_url")),
+        post["content"],
+    ]
+    return hashlib.sha256(json.dumps(fields).encode("utf8")).hexdigest()
+
+
+def render_post(post: PostInfo) -> HtmlCode:
+    with METRICS.timer("render.post"):
+        return HtmlCode(
+            TEMPLATE.format(
+                postid=post["id"],
+                # author=post["author"],
+                # author_url=post["author_url"],
+                picture=picture(post.get("icon_url")),
+                character=character(post.get("character"), post["author"]),
+                # posted=format_time(post["posted"]),
+                # permalink=post["permalink"],
+                content=render_content(post["content"]),
+            )
+        )
+
+
+def _render_chunk(posts: list[PostInfo]) -> tuple[list[HtmlCode], list[float]]:
+    """Render posts, and time each."""
+    htmls = []
+    seconds = []
+    for post in posts:
+        start = time.perf_counter()
+        htmls.append(render_post(post))
+        seconds.append(time.perf_counter() - start)
+    return htmls, seconds
+
+
+def _render_in_worker(posts: list[PostInfo], metrics: bool) -> _Rendered:
+    """`_render_chunk` in a worker process, handing back what it recorded."""
+    if not metrics:
+        return (*_render_chunk(posts), None)
+    METRICS.take()  # anything inherited from the parent is counted there
+    METRICS.enabled = True
+    return (*_render_chunk(posts), METRICS.take())
+
+
+class _SlowPosts:
+    """The posts of a story that took longer than `POST_BUDGET` to render."""
+
+    def __init__(self) -> None:
+        self.posts: list[tuple[float, int]] = []
+
+    def add(self, postid: int, seconds: float) -> None:
+        if seconds > POST_BUDGET:
+            METRICS.count("render.slow_posts")
+            sys.stderr.write(f"post {postid:d} took {seconds:.1f} s to render.\n")
+            self.posts.append((seconds, postid))
+
+    def report(self) -> None:
+        if self.posts:
+            slowest = ", ".join(
+                f"{postid:d} ({seconds:.1f} s)"
+                for seconds, postid in heapq.nlargest(SLOWEST_POSTS, self.posts)
+            )
+            sys.stderr.write(
+                f"{len(self.posts):d} posts took over {POST_BUDGET:g} s to render; "
+                f"slowest: {slowest}.\n"
+            )
+
+
+def render_content(src: HtmlCode) -> HtmlCode:
+    """Typeset and clean up the HTML of a post, parsing and serializing it once.
+
+    >>> print(render_content(HtmlCode("'Scene'<br><br>one<hr>two")))
+    <p>‘Scene’</p><p>one</p><hr><p>two</p>
+    """
+    with METRICS.timer("render.parse"):
+        post = lxml.html.fragment_fromstring(src, create_parent="post")
+    with METRICS.timer("render.smartypants"):
+        smarten_tree(post)
+    if "<p>" not in src and "<details>" not in src:
+        with METRICS.timer("render.paragraphs"):
+            to_paragraphs(post)
+    with METRICS.timer("render.serialize"):
+        return clean_html(post)
 
-def clean_html(src: HtmlCode) -> HtmlCode:
-    post = lxml.html.fragment_fromstring(src, create_parent="post")
+
+def to_paragraphs(post: lxml.html.HtmlElement) -> None:
+    """Wrap the contents of `post` in paragraphs, in place.
+
+    Two or more line breaks in a row (``<br>`` tags or newlines, with only
+    whitespace between them) separate paragraphs.  Block-level elements end the
+    paragraph they occur in.
+    """
+    blocks: list[lxml.html.HtmlElement] = []
+    para = post.makeelement("p")
+    last: lxml.html.HtmlElement | None = None  # the last child of `para`
+    # text to go after `last`, joined only once: adding to the text of an lxml
+    # element copies it, and `len` of one counts its children
+    pieces: list[str] = []
+    gap: list[str | lxml.html.HtmlElement] = []
+    breaks = 0
+
+    def add(item: str | lxml.html.HtmlElement) -> None:
+        nonlocal last
+        if isinstance(item, str):
+            pieces.append(item)
+        else:
+            flush()
+            para.append(item)
+            last = item
+
+    def flush() -> None:
+        if pieces:
+            if last is None:
+                para.text = (para.text or "") + "".join(pieces)
+            else:
+                last.tail = (last.tail or "") + "".join(pieces)
+            pieces.clear()
+
+    def end() -> None:
+        """End the paragraph and start a new one."""
+        nonlocal para, last
+        flush()
+        blocks.append(para)
+        para = post.makeelement("p")
+        last = None
+
+    def content() -> None:
+        """Start a new paragraph if the pending gap is a paragraph break."""
+        nonlocal breaks
+        if breaks >= 2:
+            if pieces or last is not None or para.text:
+                end()
+        else:
+            for item in gap:
+                add(item)
+        gap.clear()
+        breaks = 0
+
+    def text(s: str) -> None:
+        """Add text, keeping aside whitespace that may be part of a paragraph
+        break: runs with a newline, or at either end, next to a possible
+        ``<br>``."""
+        nonlocal breaks
+        pos = 0
+        for space in _SPACE.finditer(s):
+            newlines = space.group().count("\n")
+            if not newlines and 0 < space.start() and space.end() < len(s):
+                continue
+            if space.start() > pos:
+                content()
+                add(s[pos : space.start()])
+            gap.append(space.group())
+            breaks += newlines
+            pos = space.end()
+        if pos < len(s):
+            content()
+            add(s[pos:])
+
+    head = post.text
+    children = [(child, child.tail) for child in post]
+    post.clear()
+    if head:
+        text(head)
+    for child, tail in children:
+        child.tail = None
+        if child.tag == "br":
+            gap.append(child)
+            breaks += 1
+        elif child.tag in _BLOCK_TAGS:
+            content()
+            end()
+            blocks.append(child)
+        else:
+            content()
+            add(child)
+        if tail:
+            text(tail)
+    if breaks < 2:
+        content()
+    end()
+    post.extend(blocks)
+
+
+def clean_html(post: lxml.html.HtmlElement) -> HtmlCode:
     # relative links confuse `ebook-convert`; it thinks they are chapters
     post.make_links_absolute("https://www.glowfic.com")
     _replace_spoilers(post)
     for child in post:
         _replace_spoilers(child)
     return HtmlCode(
-        html_to_string(e for e in post.iterchildren() if e.text or e.tail or len(e) > 0)
+        html_to_string(
+            e
+            for e in post.iterchildren()
+            if e.text or e.tail or len(e) > 0 or e.tag in _EMPTY_KEPT
+        )
     )
 
 
@@ -137,16 +585,82 @@ def character(char_name: str | None, author: str) -> str:
 def picture(pic_url: Url | None) -> str:
     if pic_url is None:
         return ""
-    img_path = get_image_filename(pic_url)
+    img_path = icon_file(pic_url)
     return f'<span class="character-pic"><img src="images/{img_path}"></span>&thinsp;&ensp;'
 
 
+def icon_file(url: Url) -> str:
+    """The file in `images` to show for an icon: the normalized one if there is one."""
+    name = get_image_filename(url)
+    return _icon_names().get(name, name)
+
+
+@cache
+def _icon_names() -> dict[str, str]:
+    return icon_names(Path("images"))
+
+
+def forget_icon_names() -> None:
+    """Make `picture` read the icon manifest again, after it changed."""
+    _icon_names.cache_clear()
+
+
 def format_time(t: str) -> str:
     return datetime.datetime.strptime(t, "%Y-%m-%dT%H:%M:%S.%fZ").strftime(
         "%Y-%m-%d %H:%M"
     )
 
 
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Render stories to HTML.")
+    parser.add_argument("stories", nargs="+", metavar="story")
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help="number of processes to render with; several stories are then "
+        "rendered concurrently",
+    )
+    parser.add_argument(
+        "--cache",
+        type=Path,
+        metavar="FILE",
+        help="reuse posts rendered before, keeping them in this cache file",
+    )
+    parser.add_argument(
+        "--split-posts",
+        type=int,
+        default=0,
+        metavar="N",
+        help="write pages of at most N posts, with an index",
+    )
+    parser.add_argument(
+        "--split-bytes",
+        type=int,
+        default=0,
+        metavar="N",
+        help="write pages of at most about N bytes, with an index",
+    )
+    add_metrics_argument(parser)
+    args = parser.parse_args()
+    split = None
+    if args.split_posts or args.split_bytes:
+        split = Split(args.split_posts, args.split_bytes)
+    with recording(args.metrics):
+        if args.jobs <= 1:
+            for filename in args.stories:
+                process(filename, cache=args.cache, split=split)
+        else:
+            # the pool starts its workers from the threads rendering each story,
+            # and a forked worker could inherit a lock another of them holds
+            spawn = multiprocessing.get_context("spawn")
+            with ProcessPoolExecutor(max_workers=args.jobs, mp_context=spawn) as pool:
+                with ThreadPoolExecutor(max_workers=len(args.stories)) as files:
+                    for _ in files.map(
+                        lambda f: process(f, pool, args.cache, split), args.stories
+                    ):
+                        pass
+
 if __name__ == "__main__":
-    for arg in sys.argv[1:]:
-        process(arg)
+    main()